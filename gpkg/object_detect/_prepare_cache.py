@@ -0,0 +1,137 @@
+# Copyright 2017-2019 TensorHub, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+import sqlite3
+
+from gpkg.slim import _archive
+
+log = logging.getLogger()
+
+# Incremented when the format of cached values changes.
+VERSION = 1
+
+DB_NAME = "voc-prepare-cache.db"
+
+# Connections are opened once per process and database, as caches are
+# unpickled for each task run by a worker process.
+_connections = {}
+
+def default_cache_dir():
+    cache_home = (
+        os.getenv("XDG_CACHE_HOME") or
+        os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "gpkg", "object-detect")
+
+class PrepareCache(object):
+
+    # Values computed from files - e.g. parsed annotations and image
+    # digests - keyed by kind and file path. A value is used only if
+    # the file size and mtime are unchanged since the value was
+    # stored.
+    #
+    # The cache may be used from worker processes, which open their
+    # own connection. Workers only read from the cache. New values are
+    # returned to the main process as entries and stored using add.
+
+    def __init__(self, cache_dir, flush_interval=1000):
+        self.cache_dir = cache_dir
+        self.flush_interval = flush_interval
+        self._pending = []
+
+    def __getstate__(self):
+        return {
+            "cache_dir": self.cache_dir,
+            "flush_interval": self.flush_interval,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def path(self):
+        return os.path.join(self.cache_dir, DB_NAME)
+
+    def get(self, kind, path):
+        # Returns a tuple of the cached value, or None if path isn't
+        # cached or has changed, and an entry for use with add.
+        size, mtime = _file_stamp(path)
+        key = _path_key(path)
+        row = self._conn().execute(
+            "SELECT value FROM files "
+            "WHERE kind = ? AND path = ? AND size = ? AND mtime = ?",
+            (kind, key, size, mtime)).fetchone()
+        return row[0] if row else None, (kind, key, size, mtime)
+
+    def add(self, entry, value):
+        self._pending.append(entry + (value,))
+        if len(self._pending) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        db = self._conn()
+        db.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            self._pending)
+        db.commit()
+        self._pending = []
+
+    def _conn(self):
+        key = (os.getpid(), self.path)
+        try:
+            return _connections[key]
+        except KeyError:
+            db = _connections[key] = _open_db(self.path)
+            return db
+
+def _open_db(path):
+    _ensure_dir(os.path.dirname(path))
+    db = sqlite3.connect(path, timeout=60)
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version != VERSION:
+        log.debug("Initializing prepare cache %s", path)
+        db.execute("DROP TABLE IF EXISTS files")
+        db.execute("PRAGMA user_version = %i" % VERSION)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "kind TEXT, path TEXT, size INTEGER, mtime REAL, value TEXT, "
+        "PRIMARY KEY (kind, path))")
+    db.commit()
+    return db
+
+def _path_key(path):
+    if isinstance(path, _archive.ArchiveMember):
+        return "%s:%s" % (os.path.abspath(path.archive), path.name)
+    return os.path.abspath(path)
+
+def _file_stamp(path):
+    # Archive members are stamped with the archive size and mtime.
+    if isinstance(path, _archive.ArchiveMember):
+        path = path.archive
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+def _ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != 17:
+            raise
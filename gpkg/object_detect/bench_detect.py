@@ -0,0 +1,81 @@
+# Copyright 2017-2019 TensorHub, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import PIL.Image
+import six
+
+import detect
+
+def main():
+    args = _init_args()
+    image_bytes = _image_bytes(args)
+    getdata = _time_decode(_getdata_decode, image_bytes, args.iterations)
+    buffer = _time_decode(
+        detect.Detector._init_image, image_bytes, args.iterations)
+    print("getdata_decode_ms: %f" % (getdata * 1000))
+    print("buffer_decode_ms: %f" % (buffer * 1000))
+    print("decode_speedup: %f" % (getdata / buffer))
+
+def _init_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--image",
+        help="Image to decode (default is a generated image)")
+    p.add_argument(
+        "--size",
+        default="1920x1080",
+        help="Size of generated image as WIDTHxHEIGHT (1920x1080)")
+    p.add_argument(
+        "--iterations",
+        default=10,
+        type=int,
+        help="Number of times to decode the image (10)")
+    return p.parse_args()
+
+def _image_bytes(args):
+    if args.image:
+        with open(args.image, "rb") as f:
+            return f.read()
+    width, height = [int(x) for x in args.size.split("x")]
+    pixels = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    out = six.BytesIO()
+    PIL.Image.fromarray(pixels).save(out, "JPEG")
+    return out.getvalue()
+
+def _getdata_decode(image_bytes):
+    # Decode used by Detector before pixels were read from the image
+    # buffer, for comparison.
+    image = PIL.Image.open(six.BytesIO(image_bytes))
+    width, height = image.size
+    image_np = np.array(image.getdata())
+    return image_np.reshape((height, width, 3)).astype(np.uint8)
+
+def _time_decode(decode, image_bytes, iterations):
+    # Returns the mean seconds per decode.
+    decode(image_bytes)
+    start = time.time()
+    for _ in range(iterations):
+        decode(image_bytes)
+    return (time.time() - start) / iterations
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Copyright 2017-2019 TensorHub, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+import detect
+
+def main():
+    args = _init_args()
+    image = _image(args)
+    print("cpus: %i" % _cpu_count())
+    if args.compare_pinning:
+        pinning = [False, True]
+    else:
+        pinning = [args.pin_cpus]
+    for sessions in [int(x) for x in args.sessions.split(",")]:
+        for pin_cpus in pinning:
+            pool = detect.DetectorPool(
+                args.graph, args.labels, sessions,
+                args.intra_op_threads, args.inter_op_threads, pin_cpus)
+            images_per_sec = _images_per_sec(pool, image, args)
+            print("sessions_%i%s_images_per_sec: %f" % (
+                sessions, "_pinned" if pin_cpus else "", images_per_sec))
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+def _init_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--graph",
+        default="frozen_inference_graph.pb",
+        help="Path to frozen detection graph (frozen_inference_graph.pb)")
+    p.add_argument(
+        "--labels",
+        default="labels.pbtxt",
+        help="Path to label proto")
+    p.add_argument(
+        "--image",
+        help="Image to detect (default is a generated image)")
+    p.add_argument(
+        "--size",
+        default="300x300",
+        help="Size of generated image as WIDTHxHEIGHT (300x300)")
+    p.add_argument(
+        "--sessions",
+        default="1,2,4",
+        help="Comma separated pool sizes to measure (1,2,4)")
+    p.add_argument(
+        "--requests",
+        default=100,
+        type=int,
+        help="Number of images detected per pool size (100)")
+    p.add_argument(
+        "--intra-op-threads",
+        default=0,
+        type=int,
+        help="Intra op threads per session (0 - TensorFlow default)")
+    p.add_argument(
+        "--inter-op-threads",
+        default=0,
+        type=int,
+        help="Inter op threads per session (0 - TensorFlow default)")
+    p.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        help="Split available CPUs across sessions")
+    p.add_argument(
+        "--compare-pinning",
+        action="store_true",
+        help="Measure each pool size with and without --pin-cpus")
+    return p.parse_args()
+
+def _image(args):
+    if args.image:
+        with open(args.image, "rb") as f:
+            return detect.Detector._init_image(f.read())
+    width, height = [int(x) for x in args.size.split("x")]
+    return np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+
+def _images_per_sec(pool, image, args):
+    # Detects image args.requests times using one caller thread per
+    # session and returns images detected per second.
+    _warm_up(pool, image, pool.sessions)
+    remaining = [args.requests]
+    lock = threading.Lock()
+    def caller():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            pool.detect_images([image])
+    callers = [
+        threading.Thread(target=caller)
+        for _ in range(pool.sessions)
+    ]
+    start = time.time()
+    for t in callers:
+        t.start()
+    for t in callers:
+        t.join()
+    return args.requests / (time.time() - start)
+
+def _warm_up(pool, image, remaining):
+    # Holds each detector in turn so that every session runs once
+    # before timing - first runs include one time graph setup.
+    if remaining <= 0:
+        return
+    with pool.detector() as detector:
+        detector.detect_images([image])
+        _warm_up(pool, image, remaining - 1)
+
+if __name__ == "__main__":
+    main()
@@ -17,12 +17,17 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import collections
+import contextlib
+import json
 import os
+import sys
 import threading
 
 import numpy as np
 import PIL
 import six
+from six.moves import queue
 
 import tensorflow as tf
 
@@ -44,10 +49,14 @@ class Detector(object):
         "detection_classes",
     )
 
-    def __init__(self, graph_path, labels_path, box_line_size=3):
-        self._sess = tf.Session()
-        self._load_graph_def(graph_path)
-        self._init_tensors()
+    def __init__(self, graph_path, labels_path, box_line_size=3,
+                 graph=None, config=None):
+        # graph, if specified, is a graph previously loaded from
+        # graph_path, which is shared with other detectors.
+        self.graph = graph or self._load_graph(graph_path)
+        self._sess = tf.Session(graph=self.graph, config=config)
+        with self.graph.as_default():
+            self._init_tensors()
         self._category_index = self._init_category_index(labels_path)
         self._box_line_size = box_line_size
         self._lock = threading.Lock()
@@ -97,10 +106,13 @@ class Detector(object):
         self._lock.release()
 
     @staticmethod
-    def _load_graph_def(graph_path):
+    def _load_graph(graph_path):
         graph_def = tf.GraphDef()
         graph_def.ParseFromString(open(graph_path, "rb").read())
-        tf.import_graph_def(graph_def, name="")
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        return graph
 
     @staticmethod
     def _init_category_index(labels_path):
@@ -112,30 +124,65 @@ class Detector(object):
         return label_map_util.create_category_index(categories)
 
     def detect(self, image_bytes):
-        image = self._init_image(image_bytes)
-        detect_result = self._run_detect(image)
-        self._apply_detect_result(detect_result, image)
-        return detect_result, image
+        return self.detect_batch([image_bytes])[0]
+
+    def detect_batch(self, images_bytes):
+        # Returns a list of detect result and image for each item in
+        # images_bytes. Images of the same size are detected in a
+        # single session run. Images are not padded or resized to
+        # batch them, as detected boxes are relative to image size.
+        images = [
+            self._init_image(image_bytes)
+            for image_bytes in images_bytes
+        ]
+        results = self.detect_images(images)
+        for detect_result, image in zip(results, images):
+            self.render(detect_result, image)
+        return list(zip(results, images))
+
+    def detect_images(self, images):
+        # Returns a detect result for each decoded image in images
+        # without rendering detections.
+        results = [None] * len(images)
+        for indexes in self._batches(images):
+            batch_results = self._run_detect_batch(
+                [images[i] for i in indexes])
+            for i, detect_result in zip(indexes, batch_results):
+                results[i] = detect_result
+        return results
+
+    def _batches(self, images):
+        # Masks are reframed to a single image size, so graphs with
+        # masks are run one image at a time.
+        if "detection_masks" in self._detect_tensors:
+            return [[i] for i in range(len(images))]
+        by_shape = collections.OrderedDict()
+        for i, image in enumerate(images):
+            by_shape.setdefault(image.shape, []).append(i)
+        return list(by_shape.values())
 
     @staticmethod
     def _init_image(image_bytes):
+        # Returns image as a height x width x 3 uint8 array. Pixels are
+        # copied once from the decoded image buffer - the array must
+        # be writable as detections are rendered in place.
         image = PIL.Image.open(six.BytesIO(image_bytes))
-        width, height = image.size
-        image_np = np.array(image.getdata())
-        return image_np.reshape((height, width, 3)).astype(np.uint8)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return np.array(image, dtype=np.uint8)
 
-    def _run_detect(self, image):
+    def _run_detect_batch(self, images):
         inputs = {
-            self._image_tensor: np.expand_dims(image, axis=0),
-            self._image_height_tensor: image.shape[0],
-            self._image_width_tensor: image.shape[1],
+            self._image_tensor: np.stack(images),
+            self._image_height_tensor: images[0].shape[0],
+            self._image_width_tensor: images[0].shape[1],
         }
         outputs = self._sess.run(self._detect_tensors, feed_dict=inputs)
-        return self._format_result(outputs)
+        return [self._format_result(outputs, i) for i in range(len(images))]
 
     @staticmethod
-    def _format_result(result):
-        val = lambda name: result[name][0]
+    def _format_result(result, i=0):
+        val = lambda name: result[name][i]
         formatted = {
             "num_detections": int(val("num_detections")),
             "detection_classes": val("detection_classes").astype(np.uint8),
@@ -146,7 +193,7 @@ class Detector(object):
             formatted["detection_masks"] = val("detection_masks")[0]
         return formatted
 
-    def _apply_detect_result(self, detect_result, image):
+    def render(self, detect_result, image):
         vis_util.visualize_boxes_and_labels_on_image_array(
             image,
             detect_result["detection_boxes"],
@@ -157,10 +204,15 @@ class Detector(object):
             use_normalized_coordinates=True,
             line_thickness=self._box_line_size)
 
-    def write_image(self, image, path):
+    def write_image(self, image, path, quality=None):
+        # Format is determined by path extension. quality applies to
+        # JPEG images.
         image = PIL.Image.fromarray(image)
         self._ensure_dir(os.path.dirname(path))
-        image.save(path)
+        if quality is None:
+            image.save(path)
+        else:
+            image.save(path, quality=quality)
 
     @staticmethod
     def image_bytes(image, format="PNG"):
@@ -177,16 +229,342 @@ class Detector(object):
             if e.errno != 17: # exists
                 raise
 
+class DetectorPool(object):
+
+    # Detectors with separate sessions that share a graph, for use by
+    # concurrent callers. Each caller uses a detector from the pool
+    # for the duration of a call, so up to sessions calls run at
+    # once.
+    #
+    # intra_op_threads and inter_op_threads configure each session's
+    # thread pools (0 lets TensorFlow decide). If pin_cpus is true,
+    # available CPUs are split evenly across sessions and each
+    # session's threads are created on its CPUs. Pinning is best
+    # effort and is skipped on platforms without sched_setaffinity.
+
+    def __init__(self, graph_path, labels_path, sessions=1,
+                 intra_op_threads=0, inter_op_threads=0, pin_cpus=False,
+                 box_line_size=3):
+        config = tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads,
+            use_per_session_threads=True)
+        cpu_sets = _cpu_sets(sessions) if pin_cpus else [None] * sessions
+        self._detectors = queue.Queue()
+        graph = None
+        for cpus in cpu_sets:
+            with _cpu_affinity(cpus):
+                detector = Detector(
+                    graph_path, labels_path, box_line_size,
+                    graph, config)
+            graph = detector.graph
+            self._detectors.put(detector)
+        self.sessions = sessions
+
+    @contextlib.contextmanager
+    def detector(self):
+        detector = self._detectors.get()
+        try:
+            yield detector
+        finally:
+            self._detectors.put(detector)
+
+    def detect(self, image_bytes):
+        with self.detector() as detector:
+            return detector.detect(image_bytes)
+
+    def detect_batch(self, images_bytes):
+        with self.detector() as detector:
+            return detector.detect_batch(images_bytes)
+
+    def detect_images(self, images):
+        with self.detector() as detector:
+            return detector.detect_images(images)
+
+def _cpu_sets(count):
+    # Returns count lists of CPUs, splitting available CPUs evenly, or
+    # a list of None if affinity isn't supported.
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return [None] * count
+    per_set = max(1, len(cpus) // count)
+    return [
+        cpus[(i * per_set) % len(cpus):][:per_set]
+        for i in range(count)
+    ]
+
+@contextlib.contextmanager
+def _cpu_affinity(cpus):
+    # Sets the calling thread's CPU affinity while in context. Threads
+    # started in context, including session threads, inherit it.
+    if not cpus:
+        yield
+        return
+    saved = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, saved)
+
 def main():
     args = _init_args()
+    _check_args(args)
     detector = Detector(args.graph, args.labels)
+    detections = _init_detections(args)
+    try:
+        _detect_pipeline(
+            _detect_paths(args, detections), detector, detections, args)
+    finally:
+        if detections:
+            detections.close()
+
+def _check_args(args):
+    if args.no_render and args.output_format == "image":
+        _error("--no-render requires --output-format jsonl or npz")
+
+def _init_detections(args):
+    if args.output_format == "jsonl":
+        return _JsonlDetections(
+            os.path.join(args.output_dir, "detections.jsonl"),
+            append=args.skip_existing)
+    elif args.output_format == "npz":
+        return _NpzDetections(
+            os.path.join(args.output_dir, "detections.npz"),
+            append=args.skip_existing)
+    return None
+
+class _JsonlDetections(object):
+
+    # Writes a line of detections for each image as it's detected. When
+    # appending, images already in the file can be skipped using
+    # `written`.
+
+    def __init__(self, path, append=False):
+        Detector._ensure_dir(os.path.dirname(path))
+        self.written = set()
+        if append and os.path.exists(path):
+            with open(path, "r") as f:
+                self.written.update(json.loads(line)["image"] for line in f)
+        self._f = open(path, "a" if append else "w")
+        self._lock = threading.Lock()
+
+    def add(self, image_path, detect_result):
+        line = json.dumps({
+            "image": image_path,
+            "boxes": detect_result["detection_boxes"].tolist(),
+            "scores": detect_result["detection_scores"].tolist(),
+            "classes": detect_result["detection_classes"].tolist(),
+        })
+        with self._lock:
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+class _NpzDetections(object):
+
+    # Detections for all images are written when closed. boxes,
+    # scores, and classes are concatenated across images and
+    # image_index is the index in images of each detection. When
+    # appending, detections in an existing file are kept and its
+    # images can be skipped using `written`.
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self._prev = None
+        if append and os.path.exists(path):
+            with np.load(path) as prev:
+                self._prev = {name: prev[name] for name in prev.files}
+        self.written = set(
+            self._prev["images"].tolist() if self._prev else [])
+        self._images = []
+        self._results = []
+        self._lock = threading.Lock()
+
+    def add(self, image_path, detect_result):
+        with self._lock:
+            self._images.append(image_path)
+            self._results.append(detect_result)
+
+    def close(self):
+        get = lambda name, shape, dtype: (
+            np.concatenate([r[name] for r in self._results])
+            if self._results else np.zeros(shape, dtype))
+        arrays = {
+            "images": np.array(self._images, dtype=np.str_),
+            "image_index": np.repeat(
+                np.arange(len(self._results)),
+                [r["num_detections"] for r in self._results]),
+            "boxes": get("detection_boxes", (0, 4), np.float32),
+            "scores": get("detection_scores", (0,), np.float32),
+            "classes": get("detection_classes", (0,), np.uint8),
+        }
+        if self._prev:
+            arrays["image_index"] += len(self._prev["images"])
+            arrays = {
+                name: np.concatenate([self._prev[name], val])
+                for name, val in arrays.items()
+            }
+        Detector._ensure_dir(os.path.dirname(self.path))
+        np.savez_compressed(self.path, **arrays)
+
+def _detect_pipeline(paths, detector, detections, args):
+    # Images are decoded, detected, and rendered and written in
+    # concurrent stages connected by bounded queues. Decode and write
+    # stages use --decode-workers and --write-workers threads. PIL
+    # decoding and image encoding release the GIL, so these stages run
+    # alongside session runs in the detect stage, which runs on the
+    # main thread.
+    paths_queue = queue.Queue(args.queue_size)
+    decoded = queue.Queue(args.queue_size)
+    detected = queue.Queue(args.queue_size)
+    errors = []
+    _start_threads(1, _feed_stage, paths, paths_queue, args.decode_workers)
+    _start_threads(args.decode_workers, _decode_stage, paths_queue, decoded)
+    writers = _start_threads(
+        args.write_workers, _write_stage,
+        detected, detector, detections, errors, args)
+    try:
+        _detect_stage(decoded, detected, detector, errors, args)
+    finally:
+        # Writers are joined even when the detect stage fails, as
+        # daemon threads stopped at exit can leave partly written
+        # images. Writers drain the queue after an error, so these
+        # puts don't block.
+        for _ in writers:
+            detected.put(None)
+        for t in writers:
+            t.join()
+    if errors:
+        six.reraise(*errors[0])
+
+class _StageError(object):
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+def _start_threads(count, target, *args):
+    threads = []
+    for _ in range(count):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    return threads
+
+def _feed_stage(paths, paths_queue, consumers):
+    try:
+        for item in paths:
+            paths_queue.put(item)
+    finally:
+        for _ in range(consumers):
+            paths_queue.put(None)
+
+def _decode_stage(paths_queue, decoded):
+    # Errors are passed to the detect stage, which raises them.
+    while True:
+        item = paths_queue.get()
+        if item is None:
+            decoded.put(None)
+            break
+        image_path, detect_image_path = item
+        try:
+            with open(image_path, "rb") as f:
+                image = Detector._init_image(f.read())
+        except Exception:
+            decoded.put(_StageError(sys.exc_info()))
+            break
+        decoded.put((image_path, detect_image_path, image))
+
+def _detect_stage(decoded, detected, detector, errors, args):
+    for batch in _batches(_decoded_images(decoded, args), args.batch_size):
+        if errors:
+            break
+        for image_path, _detect_image_path, _image in batch:
+            print("Detecting objects in {}".format(image_path))
+        results = detector.detect_images([image for _, _, image in batch])
+        for (image_path, detect_image_path, image), result in zip(
+                batch, results):
+            result = _filter_result(result, args)
+            detected.put((image_path, detect_image_path, result, image))
+
+def _filter_result(result, args):
+    # Returns result with detections in score order, limited to
+    # --score-threshold and --top-k. Results from the graph are padded
+    # to a fixed number of detections, which are dropped.
+    scores = result["detection_scores"][:result["num_detections"]]
+    keep = np.flatnonzero(scores >= args.score_threshold)
+    keep = keep[np.argsort(-scores[keep], kind="mergesort")]
+    if args.top_k:
+        keep = keep[:args.top_k]
+    filtered = {
+        name: val[keep] for name, val in result.items()
+        if name != "num_detections"
+    }
+    filtered["num_detections"] = len(keep)
+    return filtered
+
+def _decoded_images(decoded, args):
+    running = args.decode_workers
+    while running:
+        item = decoded.get()
+        if item is None:
+            running -= 1
+        elif isinstance(item, _StageError):
+            six.reraise(*item.exc_info)
+        else:
+            yield item
+
+def _write_stage(detected, detector, detections, errors, args):
+    while True:
+        item = detected.get()
+        if item is None:
+            break
+        if errors:
+            continue
+        image_path, detect_image_path, detect_result, image = item
+        try:
+            # Detections are added after the detect image is written,
+            # so that images in detections.written have been rendered.
+            if not args.no_render:
+                detector.render(detect_result, image)
+                detector.write_image(
+                    image, detect_image_path, _image_quality(args))
+            if detections:
+                detections.add(image_path, detect_result)
+        except Exception:
+            errors.append(sys.exc_info())
+
+def _image_quality(args):
+    return args.jpeg_quality if args.image_format == "jpeg" else None
+
+def _detect_paths(args, detections):
     for image_path in _image_paths(args):
         detect_image_path = _detect_image_path_for_input(image_path, args)
-        if args.skip_existing and os.path.exists(detect_image_path):
-            print("%s exists, skipping" % detect_image_path)
-            continue
-        print("Detecting objects in {}".format(image_path))
-        _detect_objects(image_path, detect_image_path, detector)
+        if args.skip_existing:
+            # Detections files list the images they cover, whether or
+            # not they're rendered. Without one, detect images are the
+            # only record of detection.
+            if detections and image_path in detections.written:
+                print("%s detected, skipping" % image_path)
+                continue
+            if not detections and os.path.exists(detect_image_path):
+                print("%s exists, skipping" % detect_image_path)
+                continue
+        yield image_path, detect_image_path
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def _image_paths(args):
     src = args.images_dir
@@ -194,13 +572,8 @@ def _image_paths(args):
 
 def _detect_image_path_for_input(input_path, args):
     name, _ = os.path.splitext(os.path.basename(input_path))
-    return os.path.join(args.output_dir, name + ".png")
-
-def _detect_objects(image_path, detect_image_path, detector):
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
-    _result, detect_image = detector.detect(image_bytes)
-    detector.write_image(detect_image, detect_image_path)
+    ext = ".jpg" if args.image_format == "jpeg" else ".png"
+    return os.path.join(args.output_dir, name + ext)
 
 def _init_args():
     p = argparse.ArgumentParser()
@@ -223,8 +596,69 @@ def _init_args():
     p.add_argument(
         "--skip-existing",
         action="store_true",
-        help="Skip detection if detect image already exists")
+        help=(
+            "Skip images already in detections.jsonl or detections.npz, "
+            "or for image output, images with an existing detect image"))
+    p.add_argument(
+        "--output-format",
+        default="image",
+        choices=("image", "jsonl", "npz"),
+        help=(
+            "Detection output: image writes rendered images only, "
+            "jsonl and npz write detections to detections.jsonl or "
+            "detections.npz and, unless --no-render is used, rendered "
+            "images (image)"))
+    p.add_argument(
+        "--no-render",
+        action="store_true",
+        help="Don't render and write detect images")
+    p.add_argument(
+        "--image-format",
+        default="png",
+        choices=("png", "jpeg"),
+        help="Format of detect images (png)")
+    p.add_argument(
+        "--jpeg-quality",
+        default=90,
+        type=int,
+        help="Quality of JPEG detect images (90)")
+    p.add_argument(
+        "--score-threshold",
+        default=0.0,
+        type=float,
+        help="Min score of detections to output (0.0)")
+    p.add_argument(
+        "--top-k",
+        default=0,
+        type=int,
+        help="Max detections to output per image (0 - no limit)")
+    p.add_argument(
+        "--batch-size",
+        default=1,
+        type=int,
+        help=(
+            "Number of images read per detect batch; images of the "
+            "same size in a batch are detected together (1)"))
+    p.add_argument(
+        "--decode-workers",
+        default=2,
+        type=int,
+        help="Number of threads used to read and decode images (2)")
+    p.add_argument(
+        "--write-workers",
+        default=2,
+        type=int,
+        help="Number of threads used to render and write images (2)")
+    p.add_argument(
+        "--queue-size",
+        default=16,
+        type=int,
+        help="Max images buffered between pipeline stages (16)")
     return p.parse_args()
 
+def _error(msg):
+    sys.stderr.write("%s: %s\n" % (sys.argv[0], msg))
+    sys.exit(1)
+
 if __name__ == "__main__":
     main()
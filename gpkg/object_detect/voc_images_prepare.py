@@ -17,54 +17,81 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import functools
 import glob
 import hashlib
+import io
+import json
 import logging
 import os
+import posixpath
 import random
 import sys
 
 from lxml import etree
 
+import numpy as np
+import PIL.Image
 import yaml
 
 import tensorflow as tf
 
 from object_detection.utils import dataset_util
 
+from gpkg.slim import _archive
+from gpkg.slim import _image
 from gpkg.slim import _tfrecord
 
+import _prepare_cache
+
 log = logging.getLogger()
 
 IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp")
 
+BOX_COORDS = ("xmin", "ymin", "xmax", "ymax")
+
 def main(argv):
     args = _init_args(argv)
     _init_logging(args)
-    _check_existing_output(args)
-    label_ids, train, val = _init_examples(args)
+    journal = _init_journal(args)
+    cache = _init_cache(args)
+    label_ids, train, val = _init_examples(args, journal.random_seed, cache)
     log.info(
         "Found %i examples of %i classes",
         len(train) + len(val), len(label_ids))
     _ensure_output_dir(args)
-    _tfrecord.write_records(
+    train_stats = _tfrecord.write_records(
         "train",
-        _examples(train, label_ids, args),
+        _examples(
+            _unwritten("train", train, journal), label_ids, args, cache),
         len(train),
         args.output_dir,
         args.output_prefix,
         args.max_file_size,
-        type_desc="train")
-    _tfrecord.write_records(
+        type_desc="train",
+        num_shards=args.num_shards,
+        index=args.index,
+        journal=journal,
+        queue_size=args.write_queue)
+    val_stats = _tfrecord.write_records(
         "val",
-        _examples(val, label_ids, args),
+        _examples(
+            _unwritten("val", val, journal), label_ids, args, cache),
         len(val),
         args.output_dir,
         args.output_prefix,
         args.max_file_size,
-        type_desc="validation")
+        type_desc="validation",
+        num_shards=args.num_shards,
+        index=args.index,
+        journal=journal,
+        queue_size=args.write_queue)
     _write_labels(label_ids, args)
     _write_dataset_config(len(label_ids), len(val), args)
+    _tfrecord.write_stats(
+        {"train": train_stats, "val": val_stats},
+        args.output_dir, args.output_prefix)
+    journal.delete()
 
 def _init_args(argv):
     p = argparse.ArgumentParser(argv)
@@ -78,6 +105,13 @@ def _init_args(argv):
         help=(
             "directory containing images associated with annotations "
             "(required)"))
+    p.add_argument(
+        "--archive", metavar="PATH",
+        help=(
+            "zip or tar archive containing annotations and images; "
+            "annotations-dir and images-dir are directories in the "
+            "archive; compressed tar archives are decompressed to a "
+            "temporary file"))
     p.add_argument(
         "-s", "--val-split", metavar="N",
         default=30,
@@ -104,6 +138,65 @@ def _init_args(argv):
         help=(
             "max size per TF record file in MB; use 0 to disable "
             "(default is 100)"))
+    p.add_argument(
+        "-n", "--num-shards", metavar="N",
+        default=0,
+        type=int,
+        help=(
+            "number of TF record files to write per dataset; files "
+            "contain an equal number of examples and max-file-size "
+            "is ignored (default is 0 - use max-file-size)"))
+    p.add_argument(
+        "--max-side", metavar="PX",
+        default=0,
+        type=int,
+        help=(
+            "downscale images so that neither side is larger than PX "
+            "and store them as JPEG (default is 0 - store images as is)"))
+    p.add_argument(
+        "--jpeg-quality", metavar="N",
+        default=90,
+        type=int,
+        help="JPEG quality for resized images (default is 90)")
+    p.add_argument(
+        "--verify", action="store_true",
+        help=(
+            "fully decode each image before writing records, skipping "
+            "images that can't be decoded and listing them in "
+            "verify-report.txt; images are decoded by --workers "
+            "processes or, when workers is 1, a process per CPU"))
+    p.add_argument(
+        "--index", action="store_true",
+        help="write an index of record offsets for each TF record file")
+    p.add_argument(
+        "--resume", action="store_true",
+        help=(
+            "resume an interrupted prepare in output-dir, keeping "
+            "record files that were completely written; with --verify, "
+            "all images are still decoded to select examples"))
+    p.add_argument(
+        "-q", "--write-queue", metavar="N",
+        default=0,
+        type=int,
+        help=(
+            "write records on a background thread, buffering up to N "
+            "serialized examples (default is 0 - write on main thread)"))
+    p.add_argument(
+        "-w", "--workers", metavar="N",
+        default=1,
+        type=int,
+        help=(
+            "number of processes used to read images and build "
+            "examples (default is 1)"))
+    p.add_argument(
+        "--cache-dir", metavar="DIR",
+        default=_prepare_cache.default_cache_dir(),
+        help=(
+            "directory for the cache of parsed annotations and image "
+            "digests (default is %(default)s)"))
+    p.add_argument(
+        "--no-cache", action="store_true",
+        help="don't use or update the cache")
     p.add_argument(
         "--config-data-path",
         default="data",
@@ -124,27 +217,42 @@ def _init_logging(args):
         level = logging.INFO
     logging.basicConfig(format="%(message)s", level=level)
 
-def _check_existing_output(args):
-    g = lambda pattern: os.path.join(
-        args.output_dir, pattern % args.output_prefix)
-    globs = (
-        g("%strain-*.tfrecord"),
-        g("%sval-*.tfrecord"),
-        g("%slabels.txt"),
-    )
-    matches = []
-    for pattern in globs:
-        matches.extend(glob.glob(pattern))
-    if matches:
-        _error(
-            "the following record files already exist in %s: %s"
-            % (args.output_dir, ", ".join(matches)))
+def _init_journal(args):
+    try:
+        return _tfrecord.Journal.open(
+            args.output_dir,
+            args.output_prefix,
+            _journal_settings(args),
+            args.random_seed,
+            args.resume)
+    except _tfrecord.JournalError as e:
+        _error(str(e))
+
+def _init_cache(args):
+    if args.no_cache:
+        return None
+    cache = _prepare_cache.PrepareCache(args.cache_dir)
+    log.info("Using prepare cache %s", cache.path)
+    return cache
 
-def _init_examples(args):
+def _journal_settings(args):
+    return {
+        "archive": args.archive and os.path.abspath(args.archive),
+        "annotations_dir": os.path.abspath(args.annotations_dir),
+        "images_dir": os.path.abspath(args.images_dir),
+        "val_split": args.val_split,
+        "max_file_size": args.max_file_size,
+        "num_shards": args.num_shards,
+        "max_side": args.max_side,
+        "jpeg_quality": args.jpeg_quality,
+        "verify": args.verify,
+        "index": args.index,
+    }
+
+def _init_examples(args, random_seed, cache=None):
     log.info("Reading examples from %s", args.annotations_dir)
-    all_ann = _ordered_annotations(args.annotations_dir)
-    if args.random_seed is not None:
-        random.seed(args.random_seed)
+    all_ann = _ordered_annotations(args.annotations_dir, args)
+    random.seed(random_seed)
     random.shuffle(all_ann)
     train_ann, val_ann = _split_ann(all_ann, args)
     if not train_ann or not val_ann:
@@ -152,28 +260,133 @@ def _init_examples(args):
             "not enough examples to generate train "
             "and validation datasets - is val-split too "
             "low or too high?")
-    train_labels, train = _load_examples(train_ann)
-    val_labels, val = _load_examples(val_ann)
-    label_ids = _label_map(train_labels.union(val_labels))
-    return label_ids, train, val
+    labels, train, val = _scan_annotations(train_ann, val_ann, args, cache)
+    if args.verify:
+        train, val = _verify(train, val, args)
+    return _label_map(labels), train, val
 
-def _ordered_annotations(dir):
+def _ordered_annotations(dir, args):
+    if args.archive:
+        return _ordered_archive_annotations(dir, args.archive)
     return sorted(glob.glob(os.path.join(dir, "*.xml")))
 
+def _ordered_archive_annotations(dir, archive):
+    try:
+        names = _archive.names(archive)
+    except _archive.ArchiveError as e:
+        _error(str(e))
+    # Archive names are normalized, without a leading './'.
+    dir = posixpath.normpath(dir).lstrip("/")
+    if dir == ".":
+        dir = ""
+    annotations = [
+        _archive.ArchiveMember(archive, name)
+        for name in names
+        if posixpath.dirname(name) == dir and name.endswith(".xml")
+    ]
+    if not annotations:
+        _error(
+            "%s does not contain annotations in %s"
+            % (archive, dir or "the top level directory"))
+    return annotations
+
 def _split_ann(ann, args):
     val = int(len(ann) * args.val_split / 100)
     return ann[val:], ann[:val]
 
-def _load_examples(filenames):
-    examples = []
+def _scan_annotations(train_ann, val_ann, args, cache):
+    # First pass over annotations, which reads only image filenames and
+    # object labels. Annotations are fully parsed as examples are
+    # written. Returns labels and lists of (annotation path, image
+    # filename) for train and validation.
+    log.info("Scanning %i annotations", len(train_ann) + len(val_ann))
+    scanned = _tfrecord.map_examples(
+        functools.partial(_scan_annotation, cache=cache),
+        train_ann + val_ann, args.workers, 64)
     labels = set()
-    for path in filenames:
-        node = etree.fromstring(open(path, "r").read())
-        data = dataset_util.recursive_parse_xml_to_dict(node)["annotation"]
-        for obj in data.get("object") or ():
-            labels.add(obj["name"])
-        examples.append(data)
-    return labels, examples
+    examples = []
+    for path, (image_filename, ann_labels) in zip(
+            train_ann + val_ann, scanned):
+        labels.update(ann_labels)
+        examples.append((path, image_filename))
+    return labels, examples[:len(train_ann)], examples[len(train_ann):]
+
+def _scan_annotation(path, cache=None):
+    with _tfrecord.timed("scan"):
+        if cache is not None:
+            value, _entry = cache.get("annotation", path)
+            if value is not None:
+                ann = json.loads(value)
+                return (
+                    ann.get("filename"),
+                    set(obj["name"] for obj in ann.get("object") or ()))
+        image_filename = None
+        labels = set()
+        events = etree.iterparse(
+            io.BytesIO(_archive.read_bytes(path)),
+            tag=("filename", "object"))
+        for _event, elem in events:
+            if elem.tag == "filename":
+                image_filename = elem.text
+            else:
+                labels.add(elem.findtext("name"))
+                elem.clear()
+        return image_filename, labels
+
+def _load_annotation(path, cache=None, cache_entries=None):
+    if cache is not None:
+        value, entry = cache.get("annotation", path)
+        if value is not None:
+            return json.loads(value)
+    node = etree.fromstring(_archive.read_bytes(path))
+    ann = dataset_util.recursive_parse_xml_to_dict(node)["annotation"]
+    if cache is not None:
+        cache_entries.append((entry, json.dumps(ann)))
+    return ann
+
+def _verify(train, val, args):
+    # Drops examples whose image can't be decoded. Verifying decodes
+    # every image, so it always uses processes. Labels used only by
+    # dropped examples are kept so that label IDs don't depend on
+    # image errors.
+    workers = _image.verify_workers(args.workers)
+    log.info(
+        "Verifying %i images using %i processes",
+        len(train) + len(val), workers)
+    errors = iter(_tfrecord.map_examples(
+        _image.verify_path,
+        (_image_path(image_filename, args)
+         for _path, image_filename in train + val),
+        workers))
+    kept_train, bad = _verified(train, errors)
+    kept_val, bad_val = _verified(val, errors)
+    bad.extend(bad_val)
+    log.info("Skipped %i images that could not be decoded", len(bad))
+    _write_verify_report(bad, args)
+    return kept_train, kept_val
+
+def _verified(examples, errors):
+    kept = []
+    bad = []
+    for example, error in zip(examples, errors):
+        _path, image_filename = example
+        if error is None:
+            kept.append(example)
+        else:
+            log.warning("skipping %s: %s", image_filename, error)
+            bad.append((image_filename, error))
+    return kept, bad
+
+def _write_verify_report(bad, args):
+    _ensure_output_dir(args)
+    report_path = os.path.join(
+        args.output_dir,
+        args.output_prefix + "verify-report.txt")
+    log.info("Writing verify report %s", report_path)
+    with open(report_path, "w") as f:
+        f.write("# skipped\terror\n")
+        for filename, error in bad:
+            f.write("%s\t%s\n" % (filename, error))
 
 def _example_labels(examples):
     labels = set()
@@ -193,36 +406,103 @@ def _ensure_output_dir(args):
     else:
         log.debug("Created %s", args.output_dir)
 
-def _examples(ann_data, label_ids, args):
-    for ann in ann_data:
-        yield None, _tf_example(ann, label_ids, args)
+def _unwritten(basename, examples, journal):
+    return examples[journal.examples_written(basename):]
+
+def _examples(examples, label_ids, args, cache=None):
+    f = functools.partial(
+        _serialized_example,
+        label_ids=label_ids,
+        args=args,
+        cache=cache)
+    # Serialized examples include image bytes, so examples are mapped
+    # in small chunks - map_examples holds at most two chunks per
+    # worker, which bounds memory regardless of dataset size.
+    return _update_cache(
+        _tfrecord.map_examples(f, examples, args.workers, chunksize=4),
+        cache)
+
+def _update_cache(results, cache):
+    # Workers only read from the cache. Values they compute are
+    # returned with each example and stored here.
+    for example, cache_entries in results:
+        for entry, value in cache_entries:
+            cache.add(entry, value)
+        yield example
+    if cache is not None:
+        cache.flush()
 
-def _tf_example(ann, label_ids, args):
+def _serialized_example(example, label_ids, args, cache=None):
+    ann_path, _image_filename = example
+    cache_entries = []
+    with _tfrecord.timed("parse"):
+        ann = _load_annotation(ann_path, cache, cache_entries)
+    example = _tf_example(ann, label_ids, args, cache, cache_entries)
+    with _tfrecord.timed("serialize"):
+        return (None, example.SerializeToString()), cache_entries
+
+def _tf_example(ann, label_ids, args, cache=None, cache_entries=None):
     image_filename = ann["filename"]
-    image_path = os.path.join(args.images_dir, image_filename)
-    image_bytes = open(image_path, "rb").read()
-    image_digest = hashlib.sha256(image_bytes).hexdigest()
+    image_path = _image_path(image_filename, args)
+    with _tfrecord.timed("read") as t:
+        image_bytes = _archive.read_bytes(image_path)
+        t.bytes = len(image_bytes)
+    image_digest = None
+    if cache is not None:
+        image_digest, entry = cache.get("sha256", image_path)
+    if image_digest is None:
+        with _tfrecord.timed("hash") as t:
+            image_digest = hashlib.sha256(image_bytes).hexdigest()
+            t.bytes = len(image_bytes)
+        if cache is not None:
+            cache_entries.append((entry, image_digest))
+    image_bytes, image_format, image_size = _encoded_image(image_bytes, args)
+    with _tfrecord.timed("example"):
+        return _tf_example_for_image(
+            ann, image_filename, image_bytes, image_digest, label_ids,
+            image_format, image_size)
+
+def _encoded_image(image_bytes, args):
+    # Returns image bytes, format, and size (width, height) to store
+    # for image_bytes. Size is None when the image is stored as is, in
+    # which case the annotation size is used. Boxes are normalized to
+    # image size so they remain valid for resized images.
+    with _tfrecord.timed("decode"):
+        image = PIL.Image.open(io.BytesIO(image_bytes))
+    resize_opts = _image.ResizeOptions(args.max_side, 0, args.jpeg_quality)
+    if not _image.resize_enabled(resize_opts):
+        return image_bytes, image.format.lower(), None
+    with _tfrecord.timed("resize"):
+        image_bytes, image_format, height, width = _image.resize_and_encode(
+            image_bytes, image, resize_opts)
+    return image_bytes, image_format.lower(), (width, height)
+
+def _image_path(image_filename, args):
+    if args.archive:
+        return _archive.ArchiveMember(
+            args.archive,
+            posixpath.normpath(
+                posixpath.join(args.images_dir, image_filename)))
+    return os.path.join(args.images_dir, image_filename)
+
+def _tf_example_for_image(ann, image_filename, image_bytes, image_digest,
+                          label_ids, image_format="jpeg", image_size=None):
     width, height = _ann_size(ann)
-    xmin = []
-    xmax = []
-    ymin = []
-    ymax = []
-    class_text = []
-    class_label = []
-    difficult = []
-    truncated = []
-    poses = []
-    for obj in ann["object"]:
-        xmin.append(float(obj["bndbox"]["xmin"]) / width)
-        xmax.append(float(obj["bndbox"]["xmax"]) / width)
-        ymin.append(float(obj["bndbox"]["ymin"]) / height)
-        ymax.append(float(obj["bndbox"]["ymax"]) / height)
-        class_name = obj["name"]
-        class_text.append(class_name.encode())
-        class_label.append(label_ids[class_name])
-        difficult.append(int(obj["difficult"]))
-        truncated.append(int(obj["truncated"]))
-        poses.append(obj["pose"].encode())
+    objs = ann["object"]
+    boxes, valid = _normalized_boxes(objs, width, height)
+    if image_size:
+        width, height = image_size
+    objs = [obj for obj, keep in zip(objs, valid) if keep]
+    boxes = boxes[valid]
+    xmin = boxes[:, 0].tolist()
+    ymin = boxes[:, 1].tolist()
+    xmax = boxes[:, 2].tolist()
+    ymax = boxes[:, 3].tolist()
+    class_text = [obj["name"].encode() for obj in objs]
+    class_label = [label_ids[obj["name"]] for obj in objs]
+    difficult = _int_list([obj["difficult"] for obj in objs])
+    truncated = _int_list([obj["truncated"] for obj in objs])
+    poses = [obj["pose"].encode() for obj in objs]
     feature = {
         "image/height": dataset_util.int64_feature(height),
         "image/width": dataset_util.int64_feature(width),
@@ -230,7 +510,7 @@ def _tf_example(ann, label_ids, args):
         "image/source_id": dataset_util.bytes_feature(image_filename.encode()),
         "image/key/sha256": dataset_util.bytes_feature(image_digest.encode()),
         "image/encoded": dataset_util.bytes_feature(image_bytes),
-        "image/format": dataset_util.bytes_feature("jpeg".encode()),
+        "image/format": dataset_util.bytes_feature(image_format.encode()),
         "image/object/bbox/xmin": dataset_util.float_list_feature(xmin),
         "image/object/bbox/xmax": dataset_util.float_list_feature(xmax),
         "image/object/bbox/ymin": dataset_util.float_list_feature(ymin),
@@ -243,6 +523,29 @@ def _tf_example(ann, label_ids, args):
     }
     return tf.train.Example(features=tf.train.Features(feature=feature))
 
+def _normalized_boxes(objs, width, height):
+    # Returns object boxes as an N x 4 array of xmin, ymin, xmax, and
+    # ymax, normalized to image size and clipped to [0, 1], and a mask
+    # of boxes that are not degenerate (zero area after clipping).
+    boxes = np.array(
+        [[obj["bndbox"][coord] for coord in BOX_COORDS] for obj in objs],
+        dtype=np.float64).reshape(-1, 4)
+    boxes /= (width, height, width, height)
+    clipped = np.clip(boxes, 0.0, 1.0)
+    valid = (
+        (clipped[:, 2] > clipped[:, 0]) &
+        (clipped[:, 3] > clipped[:, 1]))
+    _tfrecord.stats.count("boxes", len(boxes))
+    _tfrecord.stats.count(
+        "boxes_clipped",
+        int(np.count_nonzero((clipped != boxes).any(axis=1) & valid)))
+    _tfrecord.stats.count(
+        "boxes_dropped", len(boxes) - int(np.count_nonzero(valid)))
+    return clipped, valid
+
+def _int_list(values):
+    return np.array(values, dtype=np.int64).tolist()
+
 def _ann_size(ann):
     try:
         size = ann["size"]
@@ -0,0 +1,167 @@
+# Copyright 2017-2019 TensorHub, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import collections
+import logging
+import os
+import posixpath
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+log = logging.getLogger()
+
+class ArchiveMember(collections.namedtuple(
+        "ArchiveMember", ["archive", "name"])):
+
+    # A file in a zip or tar archive, used in place of a file path.
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "%s:%s" % (self.archive, self.name)
+
+class ArchiveError(Exception):
+    pass
+
+class _Archive(object):
+
+    # Files are named by their normalized archive path - see
+    # _member_name.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        if zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(path)
+            self._tar = None
+            self._members = {
+                _member_name(info.filename): info
+                for info in self._zip.infolist()
+                if not info.filename.endswith("/")
+            }
+        else:
+            self._zip = None
+            self._tar = _open_tar(path)
+            self._members = {
+                _member_name(member.name): member
+                for member in self._tar.getmembers()
+                if member.isfile()
+            }
+
+    def names(self):
+        return list(self._members)
+
+    def read(self, name):
+        member = self._members[_member_name(name)]
+        # Archive file objects can't be shared across threads.
+        with self._lock:
+            if self._zip:
+                return self._zip.read(member)
+            return self._tar.extractfile(member).read()
+
+def _member_name(name):
+    # Archives created from a directory, e.g. with 'tar -C dir .',
+    # store names as './name'.
+    return posixpath.normpath(name).lstrip("/")
+
+def _open_tar(path):
+    # Members are read in random order so the archive must support
+    # seeking, which compressed tar archives don't without
+    # decompressing from the start.
+    try:
+        return tarfile.open(path, "r:")
+    except tarfile.ReadError:
+        return tarfile.open(_decompressed_tar(path), "r:")
+
+# Compressed tar archives are decompressed once to a temporary
+# uncompressed tar, which is shared with forked worker processes and
+# removed when the process that created it exits. This avoids
+# extracting each member to a file, but still needs disk space for
+# the uncompressed archive.
+_decompressed = {}
+
+def _decompressed_tar(path):
+    try:
+        return _decompressed[path]
+    except KeyError:
+        tmp = _decompress_tar(path)
+        atexit.register(_remove_decompressed, tmp, os.getpid())
+        _decompressed[path] = tmp
+        return tmp
+
+def _decompress_tar(path):
+    fd, tmp = tempfile.mkstemp(prefix="gpkg-archive-", suffix=".tar")
+    log.warning(
+        "%s is a compressed tar archive - decompressing to %s to read "
+        "images in any order (use a zip or uncompressed tar archive "
+        "to avoid this)", path, tmp)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            src = tarfile.open(path, "r|*")
+            dest = tarfile.open(fileobj=out, mode="w:")
+            for member in src:
+                if member.isfile():
+                    dest.addfile(member, src.extractfile(member))
+                else:
+                    dest.addfile(member)
+            dest.close()
+            src.close()
+    except tarfile.TarError as e:
+        os.remove(tmp)
+        raise ArchiveError("cannot read %s: %s" % (path, e))
+    except:
+        os.remove(tmp)
+        raise
+    return tmp
+
+def _remove_decompressed(path, pid):
+    # Forked processes inherit atexit handlers.
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
+
+# Open archives are cached per process as forked processes can't share
+# file offsets.
+_archives = {}
+_archives_lock = threading.Lock()
+
+def is_archive(path):
+    return os.path.isfile(path) and (
+        zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+def _archive(path):
+    key = (os.getpid(), path)
+    with _archives_lock:
+        try:
+            return _archives[key]
+        except KeyError:
+            archive = _archives[key] = _Archive(path)
+            return archive
+
+def names(path):
+    return sorted(_archive(path).names())
+
+def read_bytes(path):
+    # Returns the contents of path, which may be a file path or an
+    # ArchiveMember.
+    if isinstance(path, ArchiveMember):
+        return _archive(path.archive).read(path.name)
+    with open(path, "rb") as f:
+        return f.read()
@@ -16,6 +16,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
 import glob
 import os
 import re
@@ -25,6 +26,7 @@ import tensorflow as tf
 from datasets import dataset_factory
 from datasets import dataset_utils
 
+import _tfrecord
 import _util
 
 def patch_dataset_factory():
@@ -40,8 +42,8 @@ def get_split(split_name, dataset_dir, file_pattern=None, reader=None):
     labels = dataset_utils.read_label_file(dataset_dir)
     return tf.contrib.slim.dataset.Dataset(
         data_sources=source_pattern,
-        reader=tf.TFRecordReader,
-        decoder=_decoder(),
+        reader=_reader(source_pattern),
+        decoder=_decoder(source_pattern),
         num_samples=example_count,
         items_to_descriptions=_item_descriptions(),
         num_classes=len(labels),
@@ -73,20 +75,62 @@ def _example_count_from_sources(source_pattern):
             % source_pattern)
     return count
 
-def _decoder():
+def _reader(source_pattern):
+    compression = _sources_compression(source_pattern)
+    if not compression:
+        return tf.TFRecordReader
+    return functools.partial(
+        tf.TFRecordReader,
+        options=_tfrecord.record_options(compression))
+
+def _sources_compression(source_pattern):
+    compression = set(
+        _tfrecord.path_compression(source)
+        for source in glob.glob(source_pattern))
+    if len(compression) > 1:
+        _util.error(
+            "files matching '%s' use different compression types"
+            % source_pattern)
+    return compression.pop()
+
+def _decoder(source_pattern):
     keys_to_features = {
         "image/encoded": tf.FixedLenFeature((), tf.string),
         "image/format": tf.FixedLenFeature((), tf.string),
         "image/class/label": tf.FixedLenFeature([], tf.int64),
     }
     items_to_handlers = {
-        "image": tf.contrib.slim.tfexample_decoder.Image(),
+        "image": _image_handler(source_pattern),
         "label": tf.contrib.slim.tfexample_decoder.Tensor("image/class/label"),
     }
     return tf.contrib.slim.tfexample_decoder.TFExampleDecoder(
         keys_to_features,
         items_to_handlers)
 
+def _image_handler(source_pattern):
+    raw_shape = _raw_image_shape(source_pattern)
+    if raw_shape:
+        # Images prepared with --raw-pixels are stored as decoded
+        # pixels of a fixed shape.
+        return tf.contrib.slim.tfexample_decoder.Image(
+            shape=raw_shape,
+            channels=raw_shape[2])
+    return tf.contrib.slim.tfexample_decoder.Image()
+
+def _raw_image_shape(source_pattern):
+    source = sorted(glob.glob(source_pattern))[0]
+    options = _tfrecord.record_options(_tfrecord.path_compression(source))
+    for record in tf.python_io.tf_record_iterator(source, options):
+        features = tf.train.Example.FromString(record).features.feature
+        if features["image/format"].bytes_list.value[0] != b"raw":
+            return None
+        return [
+            features["image/height"].int64_list.value[0],
+            features["image/width"].int64_list.value[0],
+            features["image/channels"].int64_list.value[0],
+        ]
+    return None
+
 def _item_descriptions():
     return {
         "image": "Image",
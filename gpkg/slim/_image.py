@@ -0,0 +1,127 @@
+# Copyright 2017-2019 TensorHub, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import io
+import multiprocessing
+
+import PIL.Image
+
+# Imported the same way as this module - as gpkg.slim modules or from
+# the slim directory - so that stats are recorded in the caller's
+# _tfrecord.
+if "." in __name__:
+    from gpkg.slim import _archive
+    from gpkg.slim import _tfrecord
+else:
+    import _archive
+    import _tfrecord
+
+# max_side limits the longer side of an image, preserving aspect
+# ratio. size resizes to size x size. quality is the JPEG quality
+# used to re-encode resized images. Zero values disable resizing.
+ResizeOptions = collections.namedtuple(
+    "ResizeOptions", ["max_side", "size", "quality"])
+
+def resize_enabled(opts):
+    return bool(opts and (opts.max_side or opts.size))
+
+def resize(image, opts):
+    target = _target_size(image.size, opts)
+    if target == image.size:
+        return image
+    # For JPEGs, draft decodes at a reduced scale (down to no less
+    # than target), which is much faster than decoding at full size.
+    image.draft(image.mode, target)
+    return image.resize(target, PIL.Image.BILINEAR)
+
+def _target_size(size, opts):
+    if opts.size:
+        return (opts.size, opts.size)
+    width, height = size
+    longer = max(width, height)
+    if not opts.max_side or longer <= opts.max_side:
+        return size
+    scale = opts.max_side / longer
+    return (
+        max(1, int(round(width * scale))),
+        max(1, int(round(height * scale))))
+
+def encode_jpeg(image, quality):
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+def raw_pixels(image, opts):
+    # Returns uint8 RGB pixels, height, and width for image resized per
+    # opts.
+    resized = resize(image, opts)
+    if resized.mode != "RGB":
+        resized = resized.convert("RGB")
+    return resized.tobytes(), resized.height, resized.width
+
+def resize_and_encode(image_bytes, image, opts):
+    # Returns image bytes, format, height, and width for image resized
+    # per opts. Images are re-encoded as JPEG if they're resized or
+    # not already JPEG, otherwise image_bytes is returned unchanged.
+    resized = resize(image, opts)
+    if resized is image and image.format == "JPEG":
+        return image_bytes, "JPEG", image.height, image.width
+    return (
+        encode_jpeg(resized, opts.quality),
+        "JPEG",
+        resized.height,
+        resized.width)
+
+def verify(image_bytes):
+    # Returns None if image_bytes can be fully decoded, otherwise a
+    # description of the error. Opening an image only parses its
+    # header, so truncated or corrupt image data is only detected by
+    # decoding. JPEGs are decoded at a reduced scale, which still
+    # reads all of the image data.
+    try:
+        image = PIL.Image.open(io.BytesIO(image_bytes))
+    except IOError:
+        return "unrecognized image format"
+    try:
+        width, height = image.size
+        image.draft(image.mode, (max(1, width // 8), max(1, height // 8)))
+        image.load()
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    return None
+
+def verify_path(path):
+    # Returns verify for the image at path, which may be an
+    # ArchiveMember, or a description of the error reading it.
+    with _tfrecord.timed("verify") as t:
+        try:
+            image_bytes = _archive.read_bytes(path)
+        except (IOError, OSError) as e:
+            return str(e)
+        t.bytes = len(image_bytes)
+        return verify(image_bytes)
+
+def verify_workers(workers):
+    # Verifying decodes every image, so it uses a process per CPU
+    # unless more than one worker is specified.
+    if workers > 1:
+        return workers
+    return multiprocessing.cpu_count()
@@ -17,12 +17,26 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import contextlib
+import glob
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
+import random
+import re
+import struct
+import sys
+import threading
 import time
 import warnings
+import zlib
 
 import click
+import six
+
+from six.moves import queue
 
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=Warning)
@@ -30,52 +44,192 @@ with warnings.catch_warnings():
 
 log = logging.getLogger()
 
+COMPRESSION_TYPES = ("gzip", "zlib")
+
+LAYOUTS = ("shuffle", "round-robin", "stratified")
+
+# Each TF record is stored as a uint64 length, a uint32 length CRC,
+# the record data, and a uint32 data CRC.
+RECORD_HEADER_LEN = 12
+RECORD_FOOTER_LEN = 4
+
+# When splitting compressed files by size, the first records and every
+# Nth record after are compressed to estimate the compression ratio.
+COMPRESSION_SAMPLE_FIRST = 16
+COMPRESSION_SAMPLE_EVERY = 32
+
 class Writer(object):
 
-    def __init__(self, output_dir, basename, examples_count, max_file_size_mb):
+    def __init__(self, output_dir, basename, examples_count,
+                 max_file_size_mb, num_shards=0, compression=None,
+                 index=False, start=0, on_file_written=None,
+                 queue_size=0, shard_base=0):
         self.output_dir = output_dir
         self.basename = basename
         self.examples_count = examples_count
         self.max_file_size = (max_file_size_mb - 1) * 1024 * 1024
+        # Examples after shard_base - e.g. those added by an
+        # incremental prepare - are split into num_shards files.
+        self.shard_base = shard_base
+        self.num_shards = min(num_shards, examples_count - shard_base)
+        self.compression = compression
+        # Byte offsets are only meaningful for uncompressed files.
+        self.index = index and not compression
+        self.on_file_written = on_file_written
+        # When queue_size > 0, records are written and files are
+        # rolled over on a background thread, which reads serialized
+        # records from a queue of at most queue_size items.
+        self.queue_size = queue_size
+        self._queue = None
+        self._thread = None
+        self._thread_error = None
         self._writer = None
         self._writer_path = None
+        self._index = None
         self._cur_start = None
+        self._cur_end = None
         self._cur_size = 0
-        self._last_written = 0
+        self._cur_offset = 0
+        self._cur_labels = collections.Counter()
+        self._last_written = start
+        self._sized_count = 0
+        self._sampled_size = 0
+        self._sampled_stored_size = 0
+
+    def write(self, example, label=None):
+        example_bytes = _example_bytes(example)
+        if self.queue_size > 0:
+            self._put(example_bytes, label)
+        else:
+            self._write(example_bytes, label)
 
-    def write(self, example):
-        example_bytes = example.SerializeToString()
-        writer = self._next_writer(len(example_bytes))
-        writer.write(example_bytes)
+    def _put(self, example_bytes, label):
+        if self._thread is None:
+            self._start_thread()
+        self._raise_thread_error()
+        self._queue.put((example_bytes, label))
+
+    def _start_thread(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._write_queued)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_queued(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                self._write(*item)
+        except Exception:
+            self._thread_error = sys.exc_info()
+            # Drain the queue so the producer never blocks on put.
+            while self._queue.get() is not None:
+                pass
+
+    def _raise_thread_error(self):
+        if self._thread_error:
+            six.reraise(*self._thread_error)
+
+    def _stop_thread(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+
+    def _write(self, example_bytes, label):
+        stored_size = self._stored_size(example_bytes)
+        writer = self._next_writer(stored_size)
+        with timed("write") as t:
+            writer.write(example_bytes)
+            t.bytes = stored_size
+        if self._index:
+            self._write_index_entry(len(example_bytes), label)
+        if label is not None:
+            self._cur_labels[label] += 1
         self._last_written += 1
-        self._cur_size += len(example_bytes)
+        self._cur_size += stored_size
+
+    def _write_index_entry(self, length, label):
+        if label is None:
+            self._index.write("%i\t%i\n" % (self._cur_offset, length))
+        else:
+            self._index.write(
+                "%i\t%i\t%s\n" % (self._cur_offset, length, label))
+        self._cur_offset += RECORD_HEADER_LEN + length + RECORD_FOOTER_LEN
+
+    def _stored_size(self, example_bytes):
+        size = len(example_bytes)
+        if not self.compression or self.num_shards > 0:
+            # Sharded files are split by count, so the size is only
+            # used for write stats, which report uncompressed bytes.
+            return size
+        # Compressing records separately slightly overestimates the
+        # size of the compressed stream, which keeps files under
+        # max_file_size. Records that aren't sampled are sized using
+        # the ratio of the sampled records.
+        if self._sample_compression():
+            self._sampled_size += size
+            self._sampled_stored_size += len(zlib.compress(example_bytes))
+        if not self._sampled_size:
+            return size
+        return int(size * self._sampled_stored_size / self._sampled_size) + 1
+
+    def _sample_compression(self):
+        self._sized_count += 1
+        return (
+            self._sized_count <= COMPRESSION_SAMPLE_FIRST or
+            self._sized_count % COMPRESSION_SAMPLE_EVERY == 0)
 
     def _next_writer(self, next_len):
-        if self._writer is None or self._next_too_big(next_len):
+        if self._writer is None or self._shard_full(next_len):
             self._new_writer()
         return self._writer
 
+    def _shard_full(self, next_len):
+        if self.num_shards > 0:
+            return self._last_written >= self._cur_end
+        return self._next_too_big(next_len)
+
     def _next_too_big(self, next_len):
         return (
             self.max_file_size > 0 and
             self._cur_size + next_len > self.max_file_size)
 
     def _new_writer(self):
-        self.close()
+        self._close_writer()
         self._cur_start = self._last_written + 1
+        self._cur_end = self._shard_end(self._cur_start)
         path = os.path.join(self.output_dir, self._tfrecord_name())
-        self._writer = tf.python_io.TFRecordWriter(path)
+        self._writer = tf.python_io.TFRecordWriter(
+            path, record_options(self.compression))
         self._writer_path = path
+        if self.index:
+            self._index = open(index_path(path), "w")
+
+    def _shard_end(self, start):
+        # Shard i of num_shards contains examples i * count // num_shards
+        # + 1 through (i + 1) * count // num_shards (1-based), counted
+        # from shard_base.
+        if self.num_shards <= 0:
+            return None
+        base = self.shard_base
+        count = self.examples_count - base
+        i = ((start - base - 1) * self.num_shards + count - 1) // count
+        return base + (i + 1) * count // self.num_shards
 
-    def _tfrecord_name(self):
+    def _tfrecord_name(self, last=None):
         digits_needed = self._digits_needed(self.examples_count)
         digits_pattern = "%%0.%ii" % digits_needed
         start = digits_pattern % self._cur_start
-        if self._last_written > 0:
-            end = digits_pattern % self._last_written
+        if last is not None:
+            end = digits_pattern % last
         else:
             end = "?" * digits_needed
-        return "%s-%s-%s.tfrecord" % (self.basename, start, end)
+        return "%s-%s-%s%s.tfrecord" % (
+            self.basename, start, end, _compression_ext(self.compression))
 
     @staticmethod
     def _digits_needed(n):
@@ -86,20 +240,42 @@ class Writer(object):
         return digits
 
     def close(self, rename=True):
+        self._stop_thread()
+        if self._thread_error:
+            self._close_writer(False)
+            if rename:
+                self._raise_thread_error()
+        else:
+            self._close_writer(rename)
+
+    def _close_writer(self, rename=True):
         if self._writer is not None:
             self._writer.close()
+            if self._index:
+                self._index.close()
             if rename:
                 self._rename_writer()
             self._writer = None
             self._writer_path = None
+            self._index = None
             self._cur_size = 0
-            self._writer_path = None
+            self._cur_offset = 0
+            self._cur_labels = collections.Counter()
 
     def _rename_writer(self):
         assert self._writer is not None
-        new_path = os.path.join(self.output_dir, self._tfrecord_name())
+        new_path = os.path.join(
+            self.output_dir,
+            self._tfrecord_name(self._last_written))
         assert new_path != self._writer_path, self._writer_path
         os.rename(self._writer_path, new_path)
+        if self._index:
+            os.rename(index_path(self._writer_path), index_path(new_path))
+        if self.on_file_written:
+            self.on_file_written(
+                os.path.basename(new_path),
+                self._last_written,
+                self._cur_labels)
 
     def __enter__(self):
         return self
@@ -107,6 +283,386 @@ class Writer(object):
     def __exit__(self, exc_type, _value, _tb):
         self.close(exc_type is None)
 
+class IndexedRecords(object):
+
+    # Random access to records in uncompressed TF record files written
+    # with an index. pattern is a glob matching the record files.
+    # Records are numbered from 0 in the order they were written,
+    # which is the order of the first record number in each file
+    # name. Numbers aren't padded to a fixed width across prepares,
+    # so file names don't sort lexically in written order.
+
+    def __init__(self, pattern):
+        self._paths = []
+        self._entries = []
+        self._files = {}
+        for path in sorted(glob.glob(pattern), key=_written_order):
+            self._load_index(path)
+
+    def _load_index(self, path):
+        try:
+            f = open(index_path(path), "r")
+        except IOError:
+            raise ValueError("no index for %s" % path)
+        path_i = len(self._paths)
+        self._paths.append(path)
+        with f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t", 2)
+                label = parts[2] if len(parts) == 3 else None
+                self._entries.append(
+                    (path_i, int(parts[0]), int(parts[1]), label))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, i):
+        path_i, offset, length, _label = self._entries[i]
+        f = self._file(path_i)
+        f.seek(offset)
+        header = f.read(RECORD_HEADER_LEN)
+        record_len, = struct.unpack("<Q", header[:8])
+        if record_len != length:
+            raise ValueError(
+                "index for %s does not match record at offset %i"
+                % (self._paths[path_i], offset))
+        return f.read(length)
+
+    def _file(self, path_i):
+        try:
+            return self._files[path_i]
+        except KeyError:
+            f = self._files[path_i] = open(self._paths[path_i], "rb")
+            return f
+
+    def label(self, i):
+        return self._entries[i][3]
+
+    def label_indices(self, label):
+        return [
+            i for i, entry in enumerate(self._entries)
+            if entry[3] == label
+        ]
+
+    def records(self, indices):
+        for i in indices:
+            yield self[i]
+
+    def examples(self, indices):
+        for record in self.records(indices):
+            yield tf.train.Example.FromString(record)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+class Stats(object):
+
+    # Time and bytes processed per prepare stage, and named counts.
+    # Stage times from worker processes are added together, so they
+    # can exceed elapsed time when examples are built in parallel.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stage_seconds = collections.Counter()
+        self.stage_bytes = collections.Counter()
+        self.counts = collections.Counter()
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        timing = _Timing()
+        t0 = time.time()
+        yield timing
+        self.add(stage, time.time() - t0, timing.bytes)
+
+    def add(self, stage, seconds, bytes=0):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_bytes[stage] += bytes
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return (
+                dict(self.stage_seconds),
+                dict(self.stage_bytes),
+                dict(self.counts))
+
+    def merge(self, snapshot):
+        stage_seconds, stage_bytes, counts = snapshot
+        with self._lock:
+            self.stage_seconds.update(stage_seconds)
+            self.stage_bytes.update(stage_bytes)
+            self.counts.update(counts)
+
+class _Timing(object):
+
+    bytes = 0
+
+stats = Stats()
+
+def timed(stage):
+    return stats.timed(stage)
+
+class _ChunkCall(object):
+
+    # Applies f to each item in a chunk. In worker processes, results
+    # are returned along with the stats recorded by f, which the
+    # parent process merges. Threads record stats directly.
+
+    def __init__(self, f, collect_stats):
+        self.f = f
+        self.collect_stats = collect_stats
+
+    def __call__(self, chunk):
+        if self.collect_stats:
+            stats.reset()
+        results = [self.f(item) for item in chunk]
+        return results, stats.snapshot() if self.collect_stats else None
+
+class JournalError(Exception):
+    pass
+
+class Journal(object):
+
+    # Progress of a prepare operation, saved when created - before any
+    # records are written - and after each TF record file is written,
+    # so that an interrupted prepare can be resumed. settings are the
+    # prepare options that must not change on resume.
+
+    def __init__(self, path, random_seed, settings):
+        self.path = path
+        self.random_seed = random_seed
+        self.settings = settings
+        self._files = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        journal = cls(path, data["random_seed"], data["settings"])
+        journal._files = data["files"]
+        return journal
+
+    @classmethod
+    def open(cls, output_dir, output_prefix, settings, random_seed=None,
+             resume=False, check_existing=True):
+        # Returns the journal of an interrupted prepare in output_dir
+        # if resume is true and one exists, otherwise a new journal
+        # using random_seed or, if it's None, a randomly chosen seed.
+        # Raises JournalError if the interrupted prepare used other
+        # settings or seed, or if check_existing is true and output_dir
+        # contains records from another prepare.
+        path = journal_path(output_dir, output_prefix)
+        if resume and os.path.exists(path):
+            log.info("Resuming prepare using %s", path)
+            journal = cls.load(path)
+            if journal.settings != settings:
+                raise JournalError(
+                    "cannot resume prepare: options differ from the "
+                    "interrupted prepare (%s)" % journal.settings)
+            if random_seed not in (None, journal.random_seed):
+                raise JournalError(
+                    "cannot resume prepare: random seed differs from the "
+                    "interrupted prepare (%s)" % journal.random_seed)
+            return journal
+        if check_existing:
+            _check_existing_output(output_dir, output_prefix)
+        journal = cls(path, init_random_seed(random_seed), settings)
+        journal.save()
+        return journal
+
+    def files(self, basename):
+        return self._files.get(basename, [])
+
+    def examples_written(self, basename):
+        files = self.files(basename)
+        return files[-1]["end"] if files else 0
+
+    def label_counts(self, basename):
+        counts = collections.Counter()
+        for f in self.files(basename):
+            counts.update(f["labels"])
+        return counts
+
+    def add_file(self, basename, name, end, label_counts):
+        self._files.setdefault(basename, []).append({
+            "name": name,
+            "end": end,
+            "labels": dict(label_counts),
+        })
+        self.save()
+
+    def save(self):
+        _ensure_dir(os.path.dirname(self.path))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "random_seed": self.random_seed,
+                "settings": self.settings,
+                "files": self._files,
+            }, f)
+        os.rename(tmp_path, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def journal_path(output_dir, output_prefix):
+    return os.path.join(output_dir, output_prefix + "prepare-progress.json")
+
+def _check_existing_output(output_dir, output_prefix):
+    matches = []
+    for pattern in ("train-*.tfrecord", "val-*.tfrecord", "labels.txt"):
+        matches.extend(glob.glob(
+            os.path.join(output_dir, output_prefix + pattern)))
+    if matches:
+        raise JournalError(
+            "the following record files already exist in %s: %s "
+            "(use --resume to continue an interrupted prepare)"
+            % (output_dir, ", ".join(matches)))
+
+def _ensure_dir(path):
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+
+def init_random_seed(random_seed=None):
+    if random_seed is not None:
+        return random_seed
+    return random.randint(0, 2 ** 31 - 1)
+
+def index_path(record_path):
+    return record_path + ".index"
+
+def _compression_ext(compression):
+    if not compression:
+        return ""
+    assert compression in COMPRESSION_TYPES, compression
+    return "." + compression
+
+def record_options(compression):
+    if not compression:
+        return None
+    compression_type = getattr(
+        tf.python_io.TFRecordCompressionType,
+        compression.upper())
+    return tf.python_io.TFRecordOptions(compression_type)
+
+def path_compression(path):
+    m = re.search(r"\.(%s)\.tfrecord$" % "|".join(COMPRESSION_TYPES), path)
+    return m.group(1) if m else None
+
+def _example_bytes(example):
+    if isinstance(example, bytes):
+        return example
+    return example.SerializeToString()
+
+def apply_layout(items, layout, label):
+    # Orders items for writing. shuffle keeps items in their given
+    # order. round-robin takes one item per label in turn. stratified
+    # spreads each label evenly over the sequence in proportion to its
+    # count, so any contiguous range of records - and so any file - has
+    # close to the overall label distribution. Items with the same
+    # label keep their relative order.
+    if layout == "shuffle":
+        return items
+    by_label = {}
+    for item in items:
+        by_label.setdefault(label(item), []).append(item)
+    labels = sorted(by_label)
+    if layout == "round-robin":
+        return _round_robin([by_label[name] for name in labels])
+    elif layout == "stratified":
+        return _stratified([by_label[name] for name in labels])
+    else:
+        raise ValueError(layout)
+
+def _round_robin(groups):
+    ordered = []
+    for i in range(max(len(group) for group in groups) if groups else 0):
+        for group in groups:
+            if i < len(group):
+                ordered.append(group[i])
+    return ordered
+
+def _stratified(groups):
+    keyed = []
+    for group_i, group in enumerate(groups):
+        count = len(group)
+        for i, item in enumerate(group):
+            keyed.append(((i + 0.5) / count, group_i, item))
+    keyed.sort(key=lambda x: x[:2])
+    return [item for _pos, _group_i, item in keyed]
+
+def map_examples(f, items, workers=1, chunksize=16, threads=False,
+                 read_ahead=2):
+    # Yields f(item) for each item in order. When workers > 1, f is
+    # applied across a process pool - f must be a module level
+    # function and items and results must be picklable - or, if
+    # threads is true, a thread pool. Results are yielded in items
+    # order so output is deterministic for a given item order.
+    #
+    # Items are submitted in chunks of chunksize and at most
+    # read_ahead chunks per worker are pending at once, so a slow
+    # consumer limits how many items are read and how many results
+    # are held in memory.
+    if workers <= 1:
+        for item in items:
+            yield f(item)
+        return
+    if threads:
+        pool = multiprocessing.pool.ThreadPool(workers)
+    else:
+        pool = multiprocessing.Pool(workers)
+    call = _ChunkCall(f, not threads)
+    max_pending = max(1, read_ahead * workers)
+    pending = collections.deque()
+    try:
+        for chunk in _chunks(items, chunksize):
+            pending.append(pool.apply_async(call, (chunk,)))
+            if len(pending) >= max_pending:
+                for result in _chunk_results(pending.popleft()):
+                    yield result
+        while pending:
+            for result in _chunk_results(pending.popleft()):
+                yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+def _chunks(items, chunksize):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _chunk_results(async_result):
+    results, snapshot = async_result.get()
+    if snapshot:
+        stats.merge(snapshot)
+    return results
+
 def write_records(basename,
                   examples,
                   examples_count,
@@ -114,40 +670,208 @@ def write_records(basename,
                   output_prefix,
                   max_file_size=100,
                   write_weights=False,
-                  type_desc=None):
+                  type_desc=None,
+                  num_shards=0,
+                  compression=None,
+                  index=False,
+                  journal=None,
+                  queue_size=0,
+                  start=0):
+    # start is the number of records previously written for basename
+    # - new files are numbered from start + 1.
     type_desc = type_desc or basename
+    shard_base = start
+    if journal:
+        _remove_unjournaled(
+            basename, output_dir, output_prefix, journal, start)
+        start = max(start, journal.examples_written(basename))
+        label_counts = journal.label_counts(basename)
+        on_file_written = (
+            lambda *args: journal.add_file(basename, *args))
+    else:
+        label_counts = collections.Counter()
+        on_file_written = None
     writer = Writer(
         output_dir,
         output_prefix + basename,
         examples_count,
-        max_file_size)
-    label_counts = collections.Counter()
+        max_file_size,
+        num_shards,
+        compression,
+        index,
+        start,
+        on_file_written,
+        queue_size,
+        shard_base)
+    # Stats aren't reset, so that stages run before writing - e.g.
+    # scan and verify - are kept for the prepare totals.
+    stats_before = stats.snapshot()
+    t0 = time.time()
     with writer:
         pattern = _filename_pattern(basename, output_dir, output_prefix)
         log.info(
             "Writing %i %s records %s",
             examples_count, type_desc, pattern)
         quiet = os.getenv("NO_PROGRESS") == "1"
+        if start > 0:
+            log.info(
+                "Continuing after %i previously written %s records",
+                start, type_desc)
         with _progress(examples_count) as bar:
-            _progress_start(bar)
+            if not quiet:
+                bar.update(start)
             for label, example in examples:
-                writer.write(example)
+                writer.write(example, label)
                 if write_weights:
                     label_counts.update([label])
                 if not quiet:
                     bar.update(1)
-            _progress_finish(bar)
+    summary = _stats_summary(
+        examples_count - start,
+        time.time() - t0,
+        _snapshot_delta(stats.snapshot(), stats_before))
+    _log_stats_summary(basename, summary)
     if write_weights:
         _write_weights(basename, label_counts, output_dir, output_prefix)
+    return summary
+
+def _snapshot_delta(snapshot, before):
+    return tuple(
+        {
+            name: val - prev.get(name, 0)
+            for name, val in cur.items()
+            if val != prev.get(name, 0)
+        } for cur, prev in zip(snapshot, before))
+
+def _stats_summary(examples, seconds, snapshot):
+    stage_seconds, stage_bytes, counts = snapshot
+    written = stage_bytes.get("write", 0)
+    seconds = max(seconds, 1e-6)
+    return {
+        "examples": examples,
+        "seconds": seconds,
+        "examples_per_sec": examples / seconds,
+        "bytes_written": written,
+        "mb_per_sec": written / seconds / (1024 * 1024),
+        "stages": _stages_summary(stage_seconds, stage_bytes),
+        "counts": counts,
+    }
+
+def _stages_summary(stage_seconds, stage_bytes):
+    return {
+        name: {
+            "seconds": stage_seconds[name],
+            "bytes": stage_bytes.get(name, 0),
+        } for name in stage_seconds
+    }
+
+def _prepare_summary():
+    stage_seconds, stage_bytes, counts = stats.snapshot()
+    return {
+        "stages": _stages_summary(stage_seconds, stage_bytes),
+        "counts": counts,
+    }
 
-def _write_weights(basename, label_counts, output_dir, output_prefix):
+def _log_stats_summary(basename, summary):
+    # Logged as 'key: value' lines, which Guild records as scalars.
+    log.info("%s_examples_per_sec: %f", basename, summary["examples_per_sec"])
+    log.info("%s_mb_per_sec: %f", basename, summary["mb_per_sec"])
+    _log_stages_summary(basename, summary)
+
+def _log_stages_summary(basename, summary):
+    for name, stage in sorted(summary["stages"].items()):
+        log.info("%s_%s_seconds: %f", basename, name, stage["seconds"])
+    for name, count in sorted(summary["counts"].items()):
+        log.info("%s_%s: %i", basename, name, count)
+
+def write_stats(summaries, output_dir, output_prefix):
+    # summaries are per write_records call. Totals for the prepare,
+    # which include stages run before writing, are added as
+    # 'prepare'.
+    summaries = dict(summaries, prepare=_prepare_summary())
+    _log_stages_summary("prepare", summaries["prepare"])
+    stats_path = os.path.join(
+        output_dir,
+        output_prefix + "prepare-stats.json")
+    log.info("Writing prepare stats %s", stats_path)
+    with open(stats_path, "w") as f:
+        json.dump(summaries, f, indent=2, sort_keys=True)
+
+def _remove_unjournaled(basename, output_dir, output_prefix, journal,
+                        start):
+    written = set(f["name"] for f in journal.files(basename))
+    pattern = _filename_pattern(basename, output_dir, output_prefix)
+    for path in glob.glob(pattern):
+        if os.path.basename(path) in written:
+            continue
+        file_start = _file_start(path)
+        if file_start is not None and file_start <= start:
+            # Written by an earlier prepare
+            continue
+        log.info("Removing incomplete %s", path)
+        os.remove(path)
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+
+def _file_start(path):
+    m = re.search(r"-([0-9]+)-([0-9]+|\?+)(\.[a-z]+)?\.tfrecord$", path)
+    return int(m.group(1)) if m else None
+
+def _written_order(path):
+    start = _file_start(path)
+    return (start if start is not None else 0, path)
+
+def file_end(path):
+    # Returns the last record number in a completely written file, or
+    # None if path isn't one.
+    m = re.search(r"-[0-9]+-([0-9]+)(\.[a-z]+)?\.tfrecord$", path)
+    return int(m.group(1)) if m else None
+
+def records_written(basename, output_dir, output_prefix):
+    # Returns the number of records in completely written files for
+    # basename.
+    pattern = _filename_pattern(basename, output_dir, output_prefix)
+    count = 0
+    for path in glob.glob(pattern):
+        count = max(count, file_end(path) or 0)
+    return count
+
+def remove_records_after(basename, output_dir, output_prefix, end):
+    # Removes record files for basename, complete or not, that start
+    # after record number end.
+    pattern = _filename_pattern(basename, output_dir, output_prefix)
+    for path in glob.glob(pattern):
+        file_start = _file_start(path)
+        if file_start is not None and file_start > end:
+            log.info("Removing %s", path)
+            os.remove(path)
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+
+def write_label_weights(basename, label_counts, output_dir, output_prefix,
+                        label_ids=None):
+    # Weights are written in label ID order, which is used to look
+    # up weights by class in training. label_ids defaults to IDs
+    # assigned in label name order.
+    _write_weights(
+        basename, label_counts, output_dir, output_prefix, label_ids)
+
+def _write_weights(basename, label_counts, output_dir, output_prefix,
+                   label_ids=None):
     weights = _balanced_label_weights(label_counts)
     weights_file = os.path.join(
         output_dir,
         output_prefix + basename + "-weights.txt")
     log.info("Writing class weights %s", weights_file)
+    if label_ids:
+        # Labels without examples get a weight of 0 so that weights
+        # stay aligned with label IDs.
+        names = sorted(label_ids, key=lambda name: label_ids[name])
+        weights = {name: weights.get(name, 0.0) for name in names}
+    else:
+        names = sorted(weights)
     with open(weights_file, "w") as f:
-        for name in sorted(weights):
+        for name in names:
             f.write("%s:%f\n" % (name, weights[name]))
 
 def _balanced_label_weights(counts):
@@ -167,13 +891,3 @@ def _progress(length):
     bar = click.progressbar(length=length)
     bar.is_hidden = False
     return bar
-
-def _progress_start(_bar):
-    # Workaround progress not shown on small datasets - click progress
-    # bar apparently needs some time to setup.
-    time.sleep(0.5)
-
-def _progress_finish(_bar):
-    # Workaround stdout sync with other messages - click progress bar
-    # needs some time to stop writing.
-    time.sleep(0.1)
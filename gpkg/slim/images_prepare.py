@@ -17,8 +17,12 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import collections
+import csv
 import glob
+import hashlib
 import io
+import json
 import logging
 import os
 import random
@@ -26,8 +30,18 @@ import sys
 
 import PIL
 
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 - see _dir_entries
+    scandir = None
+
+import tensorflow as tf
+
 from slim.datasets import dataset_utils
 
+import _archive
+import _image
 import _tfrecord
 
 log = logging.getLogger()
@@ -36,33 +50,63 @@ IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp")
 
 def main(argv):
     args = _init_args(argv)
+    _check_args(args)
     _init_logging(args)
-    _check_existing_output(args)
-    label_ids, train, val = _init_examples(args)
+    if args.incremental:
+        _prepare_incremental(args)
+    else:
+        _prepare(args)
+
+def _prepare(args):
+    journal = _init_journal(args)
+    label_ids, train, val = _init_examples(args, journal.random_seed)
     log.info(
         "Found %i examples of %i classes",
         len(train) + len(val), len(label_ids))
     _ensure_output_dir(args)
-    _tfrecord.write_records(
+    train_stats = _tfrecord.write_records(
         "train",
-        _examples(train, label_ids),
+        _examples(_unwritten("train", train, journal), label_ids, args),
         len(train),
         args.output_dir, args.output_prefix,
-        args.max_file_size, True, "train")
-    _tfrecord.write_records(
+        args.max_file_size, True, "train",
+        args.num_shards, _compression(args), args.index,
+        journal, args.write_queue)
+    val_stats = _tfrecord.write_records(
         "val",
-        _examples(val, label_ids),
+        _examples(_unwritten("val", val, journal), label_ids, args),
         len(val),
         args.output_dir, args.output_prefix,
-        args.max_file_size, False, "validation")
+        args.max_file_size, False, "validation",
+        args.num_shards, _compression(args), args.index,
+        journal, args.write_queue)
     _write_labels(label_ids, args)
+    _tfrecord.write_stats(
+        {"train": train_stats, "val": val_stats},
+        args.output_dir, args.output_prefix)
+    journal.delete()
 
 def _init_args(argv):
     p = argparse.ArgumentParser(argv)
-    p.add_argument(
+    images = p.add_mutually_exclusive_group(required=True)
+    images.add_argument(
         "-i", "--images-dir", metavar="DIR",
-        required=True,
-        help="directory containing images to prepare (required)")
+        help=(
+            "directory, or zip or tar archive, containing images to "
+            "prepare; compressed tar archives are decompressed to a "
+            "temporary file"))
+    images.add_argument(
+        "--images-manifest", metavar="PATH",
+        help=(
+            "CSV or JSONL file listing images to prepare with columns "
+            "path, label, and optionally split (train or val); relative "
+            "paths are relative to the manifest directory"))
+    p.add_argument(
+        "--archive-dir", metavar="DIR",
+        help=(
+            "directory in the images archive containing label "
+            "directories (default is the archive's top level directory "
+            "if it's the only one)"))
     p.add_argument(
         "-s", "--val-split", metavar="N",
         default=30,
@@ -89,11 +133,126 @@ def _init_args(argv):
         help=(
             "max size per TF record file in MB; use 0 to disable "
             "(default is 100)"))
+    p.add_argument(
+        "-n", "--num-shards", metavar="N",
+        default=0,
+        type=int,
+        help=(
+            "number of TF record files to write per dataset; files "
+            "contain an equal number of examples and max-file-size "
+            "is ignored; with --incremental, applies to the images "
+            "added by each prepare (default is 0 - use max-file-size)"))
+    p.add_argument(
+        "--dedup", action="store_true",
+        help=(
+            "drop images with the same content as another image "
+            "and write a report to dedup-report.txt"))
+    p.add_argument(
+        "--verify", action="store_true",
+        help=(
+            "fully decode each image before writing records, skipping "
+            "images that can't be decoded and listing them in "
+            "verify-report.txt; images are decoded by --workers "
+            "processes or, when workers is 1, a process per CPU"))
+    p.add_argument(
+        "--incremental", action="store_true",
+        help=(
+            "add new and changed images in images-dir to the dataset "
+            "in output-dir as additional record files; images are "
+            "assigned to train or validation by a hash of their path"))
+    p.add_argument(
+        "-l", "--layout", metavar="LAYOUT",
+        default="shuffle",
+        choices=_tfrecord.LAYOUTS,
+        help=(
+            "order of examples across record files: shuffle, "
+            "round-robin, or stratified; round-robin takes one "
+            "example per label in turn, so when labels have different "
+            "counts later files only contain the larger labels; "
+            "stratified spreads each label evenly so that each file "
+            "is close to the overall label distribution (default is "
+            "shuffle)"))
+    p.add_argument(
+        "--max-side", metavar="PX",
+        default=0,
+        type=int,
+        help=(
+            "downscale images so that neither side is larger than PX "
+            "and store them as JPEG (default is 0 - store images as is)"))
+    p.add_argument(
+        "--resize", metavar="PX",
+        default=0,
+        type=int,
+        help=(
+            "resize images to PX x PX and store them as JPEG (default "
+            "is 0 - store images as is)"))
+    p.add_argument(
+        "--jpeg-quality", metavar="N",
+        default=90,
+        type=int,
+        help="JPEG quality for resized images (default is 90)")
+    p.add_argument(
+        "--raw-pixels", action="store_true",
+        help=(
+            "store decoded uint8 RGB pixels rather than encoded images "
+            "so that training does not decode images; requires --resize"))
+    p.add_argument(
+        "-c", "--compression", metavar="TYPE",
+        default="none",
+        choices=("none",) + _tfrecord.COMPRESSION_TYPES,
+        help=(
+            "compression used for TF record files: none, gzip, or "
+            "zlib (default is none)"))
+    p.add_argument(
+        "--index", action="store_true",
+        help=(
+            "write an index of record offsets and labels for each "
+            "TF record file (ignored when compression is used)"))
+    p.add_argument(
+        "--resume", action="store_true",
+        help=(
+            "resume an interrupted prepare in output-dir, keeping "
+            "record files that were completely written; with --verify "
+            "or --dedup, all images are still read to select "
+            "examples"))
+    p.add_argument(
+        "-q", "--write-queue", metavar="N",
+        default=0,
+        type=int,
+        help=(
+            "write records on a background thread, buffering up to N "
+            "serialized examples (default is 0 - write on main thread)"))
+    p.add_argument(
+        "-w", "--workers", metavar="N",
+        default=1,
+        type=int,
+        help=(
+            "number of processes used to read images and build "
+            "examples (default is 1)"))
+    p.add_argument(
+        "-t", "--threads", metavar="N",
+        default=8,
+        type=int,
+        help=(
+            "number of threads used to scan image directories and, "
+            "when workers is 1, to read images (default is 8)"))
     p.add_argument(
         "--debug", action="store_true",
         help="show debug info")
     return p.parse_args()
 
+def _compression(args):
+    return None if args.compression == "none" else args.compression
+
+def _check_args(args):
+    if args.raw_pixels and not args.resize:
+        _error("--raw-pixels requires --resize")
+    if args.images_manifest and args.incremental:
+        _error("--incremental cannot be used with --images-manifest")
+    if args.archive_dir and not (
+            args.images_dir and _archive.is_archive(args.images_dir)):
+        _error("--archive-dir requires an images archive")
+
 def _init_logging(args):
     if args.debug:
         level = logging.DEBUG
@@ -101,49 +260,87 @@ def _init_logging(args):
         level = logging.INFO
     logging.basicConfig(format="%(message)s", level=level)
 
-def _check_existing_output(args):
-    g = lambda pattern: os.path.join(
-        args.output_dir, pattern % args.output_prefix)
-    globs = (
-        g("%strain-*.tfrecord"),
-        g("%sval-*.tfrecord"),
-        g("%slabels.txt"),
-    )
-    matches = []
-    for pattern in globs:
-        matches.extend(glob.glob(pattern))
-    if matches:
-        _error(
-            "the following record files already exist in %s: %s"
-            % (args.output_dir, ", ".join(matches)))
-
-def _init_examples(args):
-    log.info("Reading examples from %s", args.images_dir)
-    label_ids, filenames = _ordered_images(args.images_dir)
-    if args.random_seed is not None:
-        random.seed(args.random_seed)
+def _init_journal(args):
+    try:
+        return _tfrecord.Journal.open(
+            args.output_dir,
+            args.output_prefix,
+            _journal_settings(args),
+            args.random_seed,
+            args.resume)
+    except _tfrecord.JournalError as e:
+        _error(str(e))
+
+def _journal_settings(args):
+    return {
+        "images_dir": _abspath(args.images_dir),
+        "images_manifest": _abspath(args.images_manifest),
+        "archive_dir": args.archive_dir,
+        "val_split": args.val_split,
+        "max_file_size": args.max_file_size,
+        "num_shards": args.num_shards,
+        "compression": args.compression,
+        "layout": args.layout,
+        "dedup": args.dedup,
+        "verify": args.verify,
+        "max_side": args.max_side,
+        "resize": args.resize,
+        "jpeg_quality": args.jpeg_quality,
+        "raw_pixels": args.raw_pixels,
+        "index": args.index,
+        "incremental": args.incremental,
+    }
+
+def _abspath(path):
+    return os.path.abspath(path) if path else None
+
+def _init_examples(args, random_seed):
+    if args.images_manifest:
+        log.info("Reading examples from %s", args.images_manifest)
+        label_ids, filenames, splits = _manifest_images(
+            args.images_manifest)
+    else:
+        log.info("Reading examples from %s", args.images_dir)
+        label_ids, filenames = _ordered_images(args.images_dir, args)
+        splits = {}
+    if args.verify:
+        filenames = _verify(filenames, args)
+    if args.dedup:
+        filenames = _dedup(filenames, args)
+    random.seed(random_seed)
     random.shuffle(filenames)
-    train, val = _split_examples(filenames, args)
+    train, val = _split_examples(filenames, splits, args)
     if not train or not val:
         _error(
             "not enough examples to generate train "
             "and validation datasets")
-    return label_ids, train, val
+    return label_ids, _apply_layout(train, args), _apply_layout(val, args)
 
-def _ordered_images(root):
-    labels = set()
+def _apply_layout(label_paths, args):
+    return _tfrecord.apply_layout(
+        label_paths, args.layout,
+        label=lambda label_path: label_path[0])
+
+def _ordered_images(root, args):
+    if _archive.is_archive(root):
+        return _ordered_archive_images(root, args.archive_dir)
+    label_dirs = sorted(
+        (name, path)
+        for name, path, is_dir in _dir_entries(root)
+        if is_dir)
     filenames = []
-    for name in sorted(os.listdir(root)):
-        label_dir = os.path.join(root, name)
-        if os.path.isdir(label_dir):
-            labels.add(name)
-            _apply_ordered_filenames(label_dir, name, filenames)
+    label_filenames_list = _tfrecord.map_examples(
+        _ordered_filenames, label_dirs, args.threads, 1, threads=True)
+    for label_filenames in label_filenames_list:
+        filenames.extend(label_filenames)
+    labels = [label for label, _path in label_dirs]
     return _label_map(labels), filenames
 
-def _apply_ordered_filenames(root, label, acc):
-    for name in sorted(os.listdir(root)):
-        path = os.path.join(root, name)
-        if os.path.isdir(path):
+def _ordered_filenames(label_dir):
+    label, root = label_dir
+    filenames = []
+    for name, path, is_dir in sorted(_dir_entries(root)):
+        if is_dir:
             log.warning("ignoring directory %s in %s", name, root)
             continue
         _, ext = os.path.splitext(name)
@@ -152,14 +349,250 @@ def _apply_ordered_filenames(root, label, acc):
                 "ignoring file %s in %s (unsupported extension)",
                 name, root)
             continue
-        acc.append((label, path))
+        filenames.append((label, path))
+    return filenames
+
+def _dir_entries(root):
+    # Yields (name, path, is_dir) for each entry in root. os.scandir
+    # (Python 3.5+) gets is_dir without a stat call per entry on most
+    # file systems.
+    if scandir:
+        for entry in scandir(root):
+            yield entry.name, entry.path, entry.is_dir()
+    else:
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            yield name, path, os.path.isdir(path)
+
+def _ordered_archive_images(archive, archive_dir=None):
+    # Images are read from label directories in the archive, which may
+    # be under archive_dir or a single top level directory, in the
+    # same order as images in a directory.
+    try:
+        names = _archive.names(archive)
+    except _archive.ArchiveError as e:
+        _error(str(e))
+    if archive_dir:
+        root = archive_dir.strip("/") + "/"
+        names = [name for name in names if name.startswith(root)]
+        if not names:
+            _error("%s does not contain %s" % (archive, archive_dir))
+    else:
+        root = _archive_root(names)
+    labels = set()
+    label_names = []
+    for name in names:
+        parts = name[len(root):].split("/")
+        if len(parts) == 1:
+            continue
+        if len(parts) > 2:
+            log.warning("ignoring %s in %s (not in a label directory)",
+                        name, archive)
+            continue
+        label, basename = parts
+        labels.add(label)
+        _, ext = os.path.splitext(basename)
+        if ext not in IMAGE_EXTENSIONS:
+            log.warning(
+                "ignoring file %s in %s (unsupported extension)",
+                name, archive)
+            continue
+        label_names.append((label, basename, name))
+    filenames = [
+        (label, _archive.ArchiveMember(archive, name))
+        for label, _basename, name in sorted(label_names)
+    ]
+    return _label_map(labels), filenames
+
+def _archive_root(names):
+    tops = set(name.split("/", 1)[0] for name in names)
+    if len(tops) == 1 and all("/" in name for name in names):
+        return tops.pop() + "/"
+    return ""
+
+def _manifest_images(manifest_path):
+    # Images are listed in the manifest rather than found by listing
+    # label directories. Examples are used in manifest order, which is
+    # the order of a directory walk when the manifest is sorted by
+    # label and then path. An image may be listed more than once with
+    # different labels.
+    labels = set()
+    filenames = []
+    splits = {}
+    for row in _manifest_rows(manifest_path):
+        label_path = (row["label"], row["path"])
+        labels.add(row["label"])
+        filenames.append(label_path)
+        if row["split"]:
+            splits[label_path] = row["split"]
+    if not filenames:
+        _error("no images listed in %s" % manifest_path)
+    return _label_map(labels), filenames, splits
+
+def _manifest_rows(manifest_path):
+    root = os.path.dirname(manifest_path)
+    if manifest_path.endswith(".jsonl"):
+        rows = _jsonl_manifest_rows(manifest_path)
+    else:
+        rows = _csv_manifest_rows(manifest_path)
+    for line, path, label, split in rows:
+        if not path or not label:
+            _error(
+                "%s:%i: path and label are required"
+                % (manifest_path, line))
+        if split == "validation":
+            split = "val"
+        if split not in (None, "", "train", "val"):
+            _error(
+                "%s:%i: invalid split '%s' (expected train or val)"
+                % (manifest_path, line, split))
+        yield {
+            "path": os.path.join(root, path),
+            "label": label,
+            "split": split,
+        }
+
+def _csv_manifest_rows(manifest_path):
+    # An optional header row - the first row that isn't blank or a
+    # comment - is skipped when its first column is 'path'.
+    with open(manifest_path, "r") as f:
+        first = True
+        for i, row in enumerate(csv.reader(f)):
+            if not row or row[0].startswith("#"):
+                continue
+            if first:
+                first = False
+                if row[0].strip() == "path":
+                    continue
+            if len(row) not in (2, 3):
+                _error(
+                    "%s:%i: expected path,label[,split]"
+                    % (manifest_path, i + 1))
+            row = [col.strip() for col in row]
+            yield i + 1, row[0], row[1], row[2] if len(row) == 3 else None
+
+def _jsonl_manifest_rows(manifest_path):
+    with open(manifest_path, "r") as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                _error("%s:%i: %s" % (manifest_path, i + 1, e))
+            yield (
+                i + 1,
+                row.get("path"),
+                row.get("label"),
+                row.get("split"))
+
+def _map(f, items, args, chunksize=16):
+    # Applies f to items in order using worker processes when
+    # --workers is specified, otherwise I/O threads.
+    if args.workers > 1:
+        return _tfrecord.map_examples(f, items, args.workers, chunksize)
+    return _tfrecord.map_examples(
+        f, items, args.threads, chunksize, threads=True)
+
+def _dedup(label_paths, args):
+    # Drops images with the same content as an image earlier in
+    # label_paths. This runs before the train/validation split, so
+    # the same image can't end up in both datasets.
+    log.info("Checking %i images for duplicates", len(label_paths))
+    digests = _map(
+        _image_digest,
+        (path for _label, path in label_paths),
+        args)
+    kept = []
+    duplicates = []
+    seen = {}
+    for (label, path), digest in zip(label_paths, digests):
+        original = seen.get(digest)
+        if original is None:
+            seen[digest] = (label, path)
+            kept.append((label, path))
+        else:
+            duplicates.append(((label, path), original))
+    _log_duplicates(duplicates)
+    _write_dedup_report(duplicates, args)
+    return kept
+
+def _image_digest(path):
+    return hashlib.sha256(_archive.read_bytes(path)).hexdigest()
+
+def _log_duplicates(duplicates):
+    cross_label = [
+        dup for dup, original in duplicates
+        if dup[0] != original[0]
+    ]
+    log.info(
+        "Dropped %i duplicate images (%i filed under a different label "
+        "than the kept image)", len(duplicates), len(cross_label))
+    for label, path in cross_label:
+        log.warning("%s is a duplicate image with label %s", path, label)
+
+def _write_dedup_report(duplicates, args):
+    _ensure_output_dir(args)
+    report_path = os.path.join(
+        args.output_dir,
+        args.output_prefix + "dedup-report.txt")
+    log.info("Writing duplicate images report %s", report_path)
+    with open(report_path, "w") as f:
+        f.write("# dropped\tlabel\tkept\tkept label\tflags\n")
+        for (label, path), (kept_label, kept_path) in duplicates:
+            flags = "cross-label" if label != kept_label else ""
+            f.write(
+                "%s\t%s\t%s\t%s\t%s\n"
+                % (path, label, kept_path, kept_label, flags))
+
+def _verify(label_paths, args):
+    # Drops images that can't be decoded. Verifying decodes every
+    # image, so it always uses processes.
+    workers = _image.verify_workers(args.workers)
+    log.info(
+        "Verifying %i images using %i processes",
+        len(label_paths), workers)
+    errors = _tfrecord.map_examples(
+        _image.verify_path,
+        (path for _label, path in label_paths),
+        workers)
+    kept = []
+    bad = []
+    for (label, path), error in zip(label_paths, errors):
+        if error is None:
+            kept.append((label, path))
+        else:
+            log.warning("skipping %s: %s", path, error)
+            bad.append((label, path, error))
+    log.info("Skipped %i images that could not be decoded", len(bad))
+    _write_verify_report(bad, args)
+    return kept
+
+def _write_verify_report(bad, args):
+    _ensure_output_dir(args)
+    report_path = os.path.join(
+        args.output_dir,
+        args.output_prefix + "verify-report.txt")
+    log.info("Writing verify report %s", report_path)
+    with open(report_path, "w") as f:
+        f.write("# skipped\tlabel\terror\n")
+        for label, path, error in bad:
+            f.write("%s\t%s\t%s\n" % (path, label, error))
 
 def _label_map(labels):
     return {name: i for i, name in enumerate(sorted(labels))}
 
-def _split_examples(examples, args):
-    val = int(len(examples) * args.val_split / 100)
-    return examples[val:], examples[:val]
+def _split_examples(examples, splits, args):
+    # Examples with a split in splits are assigned to it and the
+    # remaining examples are split randomly per val-split.
+    unassigned = [ex for ex in examples if ex not in splits]
+    val_count = int(len(unassigned) * args.val_split / 100)
+    val = set(unassigned[:val_count])
+    val.update(ex for ex, split in splits.items() if split == "val")
+    return (
+        [ex for ex in examples if ex not in val],
+        [ex for ex in examples if ex in val])
 
 def _ensure_output_dir(args):
     try:
@@ -170,27 +603,301 @@ def _ensure_output_dir(args):
     else:
         log.debug("Created %s", args.output_dir)
 
-def _examples(label_paths, label_ids):
-    for label, path in label_paths:
-        yield label, _tf_example(path, label_ids[label])
+def _unwritten(basename, examples, journal):
+    return examples[journal.examples_written(basename):]
 
-def _tf_example(image_path, label_id):
-    image_bytes, image_format, image_h, image_w = _load_image(image_path)
+def _prepare_incremental(args):
+    _check_incremental_args(args)
+    _remove_interrupted_records(args)
+    _check_incremental_output(args)
+    manifest = _load_manifest(args)
+    label_ids = _incremental_label_ids(manifest, args)
+    label_paths = _ordered_images(args.images_dir, args)[1]
+    added, removed = _manifest_changes(label_paths, manifest, args)
+    if args.verify:
+        added = _verify_entries(added, args)
+    label_ids = _add_new_labels(label_ids, added)
+    log.info(
+        "Found %i new or changed images and %i removed images",
+        len(added), len(removed))
+    if removed:
+        log.warning(
+            "records for %i changed or removed images remain in "
+            "existing record files - prepare without --incremental "
+            "to remove them", len(removed))
+    _ensure_output_dir(args)
+    journal = _tfrecord.Journal.open(
+        args.output_dir,
+        args.output_prefix,
+        _journal_settings(args),
+        args.random_seed,
+        check_existing=False)
+    random.seed(journal.random_seed)
+    random.shuffle(added)
+    summaries = {}
+    for basename, split, type_desc in (
+            ("train", "train", "train"),
+            ("val", "val", "validation")):
+        entries = _apply_layout_entries(
+            [entry for entry in added if entry["split"] == split],
+            args)
+        summaries[basename] = _write_incremental_records(
+            basename, type_desc, entries, label_ids, journal, args)
+    for path in removed:
+        manifest.pop(path)
+    for entry in added:
+        manifest[entry["path"]] = entry
+    _write_labels(label_ids, args)
+    _write_incremental_weights(manifest, label_ids, args)
+    _save_manifest(manifest, args)
+    _tfrecord.write_stats(summaries, args.output_dir, args.output_prefix)
+    journal.delete()
+
+def _check_incremental_args(args):
+    if args.resume:
+        _error("--resume cannot be used with --incremental")
+    if _archive.is_archive(args.images_dir):
+        _error("--incremental cannot be used with an images archive")
+    if args.dedup:
+        _error("--dedup cannot be used with --incremental")
+
+def _remove_interrupted_records(args):
+    # The manifest is saved when an incremental prepare finishes, so
+    # record files written by an interrupted prepare - which is
+    # detected by its journal - aren't in it. They're removed so that
+    # their images are written again, once.
+    path = _tfrecord.journal_path(args.output_dir, args.output_prefix)
+    if not os.path.exists(path):
+        return
+    if not _tfrecord.Journal.load(path).settings.get("incremental"):
+        return
+    log.info("Removing records from an interrupted incremental prepare")
+    manifest = _load_manifest(args)
+    for basename in ("train", "val"):
+        end = max([
+            _tfrecord.file_end(entry["file"]) or 0
+            for entry in manifest.values()
+            if entry["split"] == basename
+        ] or [0])
+        _tfrecord.remove_records_after(
+            basename, args.output_dir, args.output_prefix, end)
+
+def _check_incremental_output(args):
+    manifest_path = _manifest_path(args)
+    if not os.path.exists(manifest_path):
+        g = lambda pattern: os.path.join(
+            args.output_dir, pattern % args.output_prefix)
+        if glob.glob(g("%strain-*.tfrecord")):
+            _error(
+                "%s does not exist - record files in %s were not "
+                "prepared with --incremental"
+                % (manifest_path, args.output_dir))
+
+def _manifest_path(args):
+    return os.path.join(
+        args.output_dir,
+        args.output_prefix + "prepare-manifest.jsonl")
+
+def _load_manifest(args):
+    # Manifest entries are keyed by image path relative to
+    # images-dir. Each entry records the size, mtime, label, split, and
+    # record file of an image written to the dataset.
+    manifest = {}
+    path = _manifest_path(args)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                manifest[entry["path"]] = entry
+    return manifest
+
+def _save_manifest(manifest, args):
+    path = _manifest_path(args)
+    log.info("Writing prepare manifest %s", path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for key in sorted(manifest):
+            f.write(json.dumps(manifest[key], sort_keys=True))
+            f.write("\n")
+    os.rename(tmp_path, path)
+
+def _incremental_label_ids(manifest, args):
+    # Existing label IDs must not change as they're used in existing
+    # records.
+    if not manifest:
+        return {}
+    labels_path = os.path.join(
+        args.output_dir,
+        args.output_prefix + "labels.txt")
+    label_ids = {}
+    with open(labels_path, "r") as f:
+        for line in f:
+            id, name = line.rstrip("\n").split(":", 1)
+            label_ids[name] = int(id)
+    return label_ids
+
+def _add_new_labels(label_ids, added):
+    label_ids = dict(label_ids)
+    next_id = max(label_ids.values()) + 1 if label_ids else 0
+    for label in sorted(set(entry["label"] for entry in added)):
+        if label not in label_ids:
+            label_ids[label] = next_id
+            next_id += 1
+    return label_ids
+
+def _manifest_changes(label_paths, manifest, args):
+    stats = _tfrecord.map_examples(
+        os.stat,
+        (path for _label, path in label_paths),
+        args.threads,
+        threads=True)
+    added = []
+    seen = set()
+    removed = []
+    for (label, path), st in zip(label_paths, stats):
+        key = os.path.relpath(path, args.images_dir)
+        seen.add(key)
+        cur = manifest.get(key)
+        if (cur and cur["size"] == st.st_size and
+                cur["mtime"] == st.st_mtime and cur["label"] == label):
+            continue
+        if cur:
+            removed.append(key)
+        added.append({
+            "path": key,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "label": label,
+            "split": _hash_split(key, args),
+        })
+    removed.extend(key for key in manifest if key not in seen)
+    return added, removed
+
+def _verify_entries(entries, args):
+    # Images that fail verification aren't added to the manifest and
+    # are verified again by the next incremental prepare.
+    label_paths = [
+        (entry["label"], os.path.join(args.images_dir, entry["path"]))
+        for entry in entries
+    ]
+    kept = set(path for _label, path in _verify(label_paths, args))
+    return [
+        entry for entry, (_label, path) in zip(entries, label_paths)
+        if path in kept
+    ]
+
+def _hash_split(path, args):
+    # Stable assignment by path so that adding images doesn't move
+    # existing images between train and validation.
+    digest = hashlib.sha1(path.replace(os.path.sep, "/").encode("utf-8"))
+    bucket = int(digest.hexdigest()[:8], 16) % 100
+    return "val" if bucket < args.val_split else "train"
+
+def _apply_layout_entries(entries, args):
+    return _tfrecord.apply_layout(
+        entries, args.layout,
+        label=lambda entry: entry["label"])
+
+def _write_incremental_records(basename, type_desc, entries, label_ids,
+                               journal, args):
+    start = _tfrecord.records_written(
+        basename, args.output_dir, args.output_prefix)
+    label_paths = [
+        (entry["label"], os.path.join(args.images_dir, entry["path"]))
+        for entry in entries
+    ]
+    summary = _tfrecord.write_records(
+        basename,
+        _examples(label_paths, label_ids, args),
+        start + len(entries),
+        args.output_dir, args.output_prefix,
+        args.max_file_size, False, type_desc,
+        args.num_shards, _compression(args), args.index,
+        journal, args.write_queue, start)
+    _apply_record_files(entries, start, journal.files(basename))
+    return summary
+
+def _apply_record_files(entries, start, files):
+    files = iter(files)
+    cur = None
+    for i, entry in enumerate(entries):
+        while cur is None or cur["end"] < start + i + 1:
+            cur = next(files)
+        entry["file"] = cur["name"]
+
+def _write_incremental_weights(manifest, label_ids, args):
+    counts = collections.Counter(
+        entry["label"] for entry in manifest.values()
+        if entry["split"] == "train")
+    _tfrecord.write_label_weights(
+        "train", counts, args.output_dir, args.output_prefix, label_ids)
+
+def _examples(label_paths, label_ids, args):
+    resize_opts = _resize_opts(args)
+    items = (
+        (label, path, label_ids[label], resize_opts, args.raw_pixels)
+        for label, path in label_paths)
+    return _map(_serialized_example, items, args)
+
+def _resize_opts(args):
+    return _image.ResizeOptions(args.max_side, args.resize, args.jpeg_quality)
+
+def _serialized_example(item):
+    label, path, label_id, resize_opts, raw = item
+    if raw:
+        example = _raw_tf_example(path, label_id, resize_opts)
+    else:
+        example = _tf_example(path, label_id, resize_opts)
+    with _tfrecord.timed("serialize"):
+        return label, example.SerializeToString()
+
+def _tf_example(image_path, label_id, resize_opts=None):
+    image_bytes, image_format, image_h, image_w = _load_image(
+        image_path, resize_opts)
     log.debug(
         "%s: format=%s size=%i height=%i width=%i",
         image_path, image_format, len(image_bytes), image_h, image_w)
-    return dataset_utils.image_to_tfexample(
-        image_bytes,
-        image_format.encode(),
-        image_h,
-        image_w,
-        label_id)
-
-def _load_image(path):
-    image_bytes = open(path, "rb").read()
-    image = PIL.Image.open(io.BytesIO(image_bytes))
+    with _tfrecord.timed("example"):
+        return dataset_utils.image_to_tfexample(
+            image_bytes,
+            image_format.encode(),
+            image_h,
+            image_w,
+            label_id)
+
+def _raw_tf_example(image_path, label_id, resize_opts):
+    image = _open_image(image_path)[1]
+    with _tfrecord.timed("resize"):
+        pixels, image_h, image_w = _image.raw_pixels(image, resize_opts)
+    log.debug(
+        "%s: format=raw size=%i height=%i width=%i",
+        image_path, len(pixels), image_h, image_w)
+    with _tfrecord.timed("example"):
+        feature = {
+            "image/encoded": dataset_utils.bytes_feature(pixels),
+            "image/format": dataset_utils.bytes_feature(b"raw"),
+            "image/class/label": dataset_utils.int64_feature(label_id),
+            "image/height": dataset_utils.int64_feature(image_h),
+            "image/width": dataset_utils.int64_feature(image_w),
+            "image/channels": dataset_utils.int64_feature(3),
+        }
+        return tf.train.Example(features=tf.train.Features(feature=feature))
+
+def _load_image(path, resize_opts=None):
+    image_bytes, image = _open_image(path)
+    if _image.resize_enabled(resize_opts):
+        with _tfrecord.timed("resize"):
+            return _image.resize_and_encode(image_bytes, image, resize_opts)
     return image_bytes, image.format, image.height, image.width
 
+def _open_image(path):
+    with _tfrecord.timed("read") as t:
+        image_bytes = _archive.read_bytes(path)
+        t.bytes = len(image_bytes)
+    with _tfrecord.timed("decode"):
+        image = PIL.Image.open(io.BytesIO(image_bytes))
+    return image_bytes, image
+
 def _write_labels(label_ids, args):
     labels_name = args.output_prefix + "labels.txt"
     log.info(